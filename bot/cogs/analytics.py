@@ -0,0 +1,177 @@
+from datetime import timedelta
+
+import discord
+import numpy as np
+from discord.ext import commands
+
+from bot.cogs import stats
+from bot.core.context import Context
+from bot.core.embed import Embed
+from bot.mikro import Mikro
+from bot.util import ansi, checks, activity, time_util
+from bot.util import database as db
+
+DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+SHADES = ' ░▒▓█'
+SPARKS = '▁▂▃▄▅▆▇█'
+
+
+class ActivityColumns:
+    """
+    Columns of the ``messages`` table for one guild, loaded into NumPy arrays.
+    """
+
+    def __init__(self, rows, *, start: float, end: float):
+        self.start = start
+        self.end = end
+        self.time = np.fromiter((r['epoch'] for r in rows), dtype=np.float64, count=len(rows))
+        self.channel_id = np.fromiter((r['channel_id'] for r in rows), dtype=np.int64, count=len(rows))
+        self.user_id = np.fromiter((r['user_id'] for r in rows), dtype=np.int64, count=len(rows))
+        self.type = np.fromiter((r['type'] for r in rows), dtype=np.int64, count=len(rows))
+
+    def __len__(self):
+        return len(self.time)
+
+    def filter(self, mask: np.ndarray):
+        copy = ActivityColumns([], start=self.start, end=self.end)
+        copy.time = self.time[mask]
+        copy.channel_id = self.channel_id[mask]
+        copy.user_id = self.user_id[mask]
+        copy.type = self.type[mask]
+        return copy
+
+    def hour_of_week(self) -> np.ndarray:
+        """7x24 array of message counts, Monday first"""
+        hours = (self.time // 3600).astype(np.int64)
+        # The epoch was a Thursday
+        weekday = (hours // 24 + 3) % 7
+        index = weekday * 24 + hours % 24
+        return np.bincount(index, minlength=7 * 24).reshape(7, 24)
+
+    def channel_trends(self, *, top=8) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns channel ids ordered by activity and a matrix of their daily message counts.
+        """
+        days = max(1, int(np.ceil((self.end - self.start) / 86400)))
+        channels, inverse = np.unique(self.channel_id, return_inverse=True)
+        day = np.clip(((self.time - self.start) // 86400).astype(np.int64), 0, days - 1)
+        counts = np.bincount(inverse * days + day, minlength=len(channels) * days).reshape(len(channels), days)
+        order = np.argsort(counts.sum(axis=1))[::-1][:top]
+        return channels[order], counts[order]
+
+    def type_breakdown(self) -> np.ndarray:
+        return np.bincount(self.type, minlength=len(stats.MessageType))
+
+
+def shade(values: np.ndarray, characters: str) -> np.ndarray:
+    """Maps every value to a character relative to the max value"""
+    top = values.max() if values.size else 0
+    if top == 0:
+        return np.full(values.shape, characters[0])
+    index = np.ceil(values / top * (len(characters) - 1)).astype(np.int64)
+    return np.array(list(characters))[index]
+
+
+def heatmap_block(counts: np.ndarray) -> str:
+    cells = shade(counts, SHADES)
+    formatted = [
+        f'{ansi.RESET}{ansi.format_attributes(ansi.WHITE, ansi.UNDERLINE, ansi.BOLD)}Hour (UTC)',
+        f'{ansi.RESET}{ansi.format_attributes(ansi.GRAY)}    0     6     12    18',
+    ]
+    for day, row in zip(DAYS, cells):
+        formatted.append(
+            f'{ansi.RESET}{ansi.format_attributes(ansi.CYAN)}{day} '
+            f'{ansi.RESET}{ansi.format_attributes(ansi.GREEN)}{"".join(row)}'
+        )
+    peak_day, peak_hour = np.unravel_index(np.argmax(counts), counts.shape)
+    formatted.append('')
+    formatted.append(
+        f'{ansi.RESET}{ansi.format_attributes(ansi.GRAY)}Peak '
+        f'{ansi.RESET}{DAYS[peak_day]} {peak_hour:02d}:00 ({counts[peak_day, peak_hour]} messages)'
+    )
+    return '```ANSI\n{0}\n```'.format('\n'.join(formatted))
+
+
+class Analytics(commands.Cog):
+
+    def __init__(self, bot):
+        self.bot: Mikro = bot
+
+    async def get_columns(self, guild_id, *, days=7) -> ActivityColumns:
+        command = 'SELECT ((message_id >> 22) + {0}) / 1000.0::float8 epoch, channel_id, user_id, type FROM messages ' \
+                  'WHERE guild_id = $1 AND message_id >= $2;'.format(db.DISCORD_EPOCH)
+        # Include what is still waiting to be written
+        await self.bot.get_cog('Stats').writer.flush()
+        now = time_util.get_utc()
+        start = now - timedelta(days=days)
+        async with db.MaybeAcquire(pool=self.bot.pool) as con:
+            rows = await con.fetch(command, guild_id, stats.Messages.__partition__.bound(start))
+        return ActivityColumns(rows, start=activity.to_epoch(start), end=activity.to_epoch(now))
+
+    async def cog_check(self, ctx: Context) -> bool:
+        return ctx.guild is not None and await checks.raw_is_manager(ctx)
+
+    @commands.hybrid_group(name='activity', description='Message activity analytics')
+    async def activity_group(self, ctx: Context):
+        pass
+
+    @activity_group.command(name='heatmap', description='Messages by hour of the week')
+    async def heatmap(self, ctx: Context, *, channel: discord.TextChannel = None):
+        await ctx.defer()
+        columns = await self.get_columns(ctx.guild.id)
+        if channel is not None:
+            columns = columns.filter(columns.channel_id == channel.id)
+        if len(columns) == 0:
+            await ctx.send('No messages in the last week!')
+            return
+        embed = Embed(title='Activity for {0}'.format(channel.name if channel else ctx.guild.name))
+        embed.set_description(heatmap_block(columns.hour_of_week()))
+        await ctx.send(embed=embed)
+
+    @activity_group.command(name='channels', description='Daily messages in the most active channels')
+    async def channels(self, ctx: Context):
+        await ctx.defer()
+        columns = await self.get_columns(ctx.guild.id)
+        if len(columns) == 0:
+            await ctx.send('No messages in the last week!')
+            return
+        channel_ids, counts = columns.channel_trends()
+        lines = []
+        for channel_id, row in zip(channel_ids, counts):
+            channel = ctx.guild.get_channel(int(channel_id))
+            name = '#' + channel.name if channel else str(channel_id)
+            lines.append(
+                f'{ansi.RESET}{ansi.format_attributes(ansi.CYAN)}{name[:18]:<18} '
+                f'{ansi.RESET}{ansi.format_attributes(ansi.GREEN)}{"".join(shade(row, SPARKS))} '
+                f'{ansi.RESET}{ansi.format_attributes(ansi.GRAY)}{row.sum()}'
+            )
+        embed = Embed(title='Channel activity (last 7 days)')
+        embed.set_description('```ANSI\n{0}\n```'.format('\n'.join(lines)))
+        await ctx.send(embed=embed)
+
+    @activity_group.command(name='types', description='Breakdown of message types')
+    async def types(self, ctx: Context, *, member: discord.Member = None):
+        await ctx.defer()
+        columns = await self.get_columns(ctx.guild.id)
+        if member is not None:
+            columns = columns.filter(columns.user_id == member.id)
+        if len(columns) == 0:
+            await ctx.send('No messages in the last week!')
+            return
+        counts = columns.type_breakdown()
+        percent = counts / counts.sum() * 100
+        lines = []
+        for message_type, count, value in zip(stats.MessageType, counts, percent):
+            bar = '█' * int(round(value / 5))
+            lines.append(
+                f'{ansi.RESET}{ansi.format_attributes(ansi.CYAN)}{message_type.name:<11} '
+                f'{ansi.RESET}{ansi.format_attributes(ansi.PINK)}{bar:<20} '
+                f'{ansi.RESET}{value:>5.1f}{ansi.format_attributes(ansi.GRAY)} % ({count})'
+            )
+        embed = Embed(title='Message types for {0}'.format(member.display_name if member else ctx.guild.name))
+        embed.set_description('```ANSI\n{0}\n```'.format('\n'.join(lines)))
+        await ctx.send(embed=embed)
+
+
+async def setup(bot):
+    await bot.add_cog(Analytics(bot))
@@ -63,7 +63,7 @@ class RequestTagsDropdown(discord.ui.Select):
         await self.message.delete()
         await self.thread.edit(name=FeatureRequests.get_type_name(self.values[0], self.thread))
         thread = await self.bot.thread_handler.get_thread(self.thread.id)
-        await thread.update_tags(request_types[self.values[0]][2], pool=self.bot.pool)
+        await thread.update_tags(request_types[self.values[0]][2])
         await interaction.response.send_message('Done!')
 
 
@@ -301,7 +301,7 @@ class FeatureRequests(commands.Cog):
         request = FeatureRequest(self.bot, None, "", [], [], DecidedType.undecided, message.content)
 
         thread_message = await message.channel.send(embed=embed)
-        async with self.bot.thread_handler.lock:
+        async with self.bot.thread_handler.locks.hold(thread_message.id):
             thread = await thread_message.create_thread(name=self.get_name(message.content))
             request.thread_id = thread.id
             data = await ThreadData.from_thread(thread)
@@ -1,7 +1,11 @@
-from collections import defaultdict
-from typing import Callable
+import time
+from typing import Optional
 
+import discord
 from discord.ext import commands
+from lru import LRU
+
+import bot as bot_global
 
 from bot.cogs.thread import ThreadData
 from bot.core.context import Context
@@ -9,66 +13,47 @@ from bot.core.embed import Embed
 from bot.mikro import Mikro
 from bot.util import database as db
 
+PAGE_SIZE = 10
+# Control characters around matched words in snippets. They can't show up in messages, so they're swapped for bold
+# after the rest of the snippet is escaped.
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_STOP = '\x03'
+HEADLINE_OPTIONS = 'MaxWords=14, MinWords=5, MaxFragments=1, StartSel={0}, StopSel={1}'.format(HIGHLIGHT_START, HIGHLIGHT_STOP)
 
-class Parameter:
-
-    def __init__(self, table: str, condition: Callable, query_input: str = None, order_by: Callable = None):
-        self.table = table
-        self.condition = condition
-        self.query_input = query_input
-        self.order_by = order_by
+# websearch_to_tsquery handles quotes, "or" and "-" and never throws. Every term is then made a prefix match.
+TSQUERY = r"""to_tsquery(regexp_replace(websearch_to_tsquery($1)::text, '''([^'']+)''', '''\1'':*', 'g'))"""
 
-    def copy(self, query_input: str):
-        return Parameter(self.table, self.condition, query_input)
+# Most matches that are ranked for one query
+MAX_RESULTS = 1000
 
-    def get_condition(self):
-        return self.condition(self.query_input)
+# The rank order of a query is computed once (ranking every match and sorting them is the expensive part) and kept, so
+# every page after is a primary key lookup of its own ids. Snippets are only made for the rows on the page.
+#
+# A search that has no order yet gets the tsquery, the order and the rows of its page in one round trip: a single row
+# with the order and a NULL page when nothing matched.
+SEARCH = """
+WITH q AS (SELECT {0} AS query),
+ranked AS (
+    SELECT m.message_id, row_number() OVER (ORDER BY ts_rank(m.message_content_tsv, q.query) DESC, m.message_id DESC) AS position
+    FROM q, thread_messages m JOIN threads ON threads.thread_id = m.thread
+    WHERE m.message_content_tsv @@ q.query AND threads.public
+    ORDER BY position
+    LIMIT $2
+)
+SELECT o.query_text, o.ids, p.* FROM (
+    SELECT (SELECT query::text FROM q) AS query_text, ARRAY(SELECT message_id FROM ranked ORDER BY position) AS ids
+) o LEFT JOIN LATERAL (
+    SELECT m.thread, m.message_id, threads.*, ts_headline(m.message_content, q.query, '{1}') AS headline
+    FROM q, ranked r JOIN thread_messages m ON m.message_id = r.message_id JOIN threads ON threads.thread_id = m.thread
+    WHERE r.position > $3 AND r.position <= $4
+) p ON TRUE;
+""".format(TSQUERY, HEADLINE_OPTIONS)
 
-    def get_order(self):
-        if self.order_by is None:
-            return None
-        return self.order_by(self.query_input)
-
-
-PARAMETERS = {
-    'content': Parameter(
-        'thread_messages',
-        lambda x: ('message_content_tsv @@ to_tsquery($1)', [' & '.join(x.split(' '))]),
-        order_by=lambda x: ('ORDER BY ts_rank(message_content_tsv, to_tsquery($1)', [' & '.join(x.split(' '))])
-    )
-}
-
-
-class Query(commands.Cog):
-
-    def __init__(self, parameters: list[Parameter]):
-        self.parameters = parameters
-
-    def get_queries(self) -> dict[str, tuple[str, list[object]]]:
-        tables = defaultdict(list)
-        orders = defaultdict(list)
-        for parameter in self.parameters:
-            tables[parameter.table].append(parameter.get_condition())
-            order = parameter.get_order()
-            if order is not None:
-                orders[parameter.table].append(order)
-        queries = {}
-        for table, conds_vars in tables.items():
-            variables = []
-            i = 0
-            conditions = []
-            for c, v in conds_vars:
-                for num in range(1, len(v) + 1):
-                    i += 1
-                    c = c.replace('${0}'.format(num), '${0}'.format(i))
-                    variables.append(v[num - 1])
-                conditions.append(c)
-            q = f"SELECT * FROM {table} WHERE {' OR '.join(conditions)}"
-            if table in orders:
-                q += ' ORDER BY ' + orders[table][0] + ' DESC'
-            q += ' LIMIT 15;'
-            queries[table] = (q, variables)
-        return queries
+PAGE = """
+SELECT m.thread, m.message_id, threads.*, ts_headline(m.message_content, $1::tsquery, '{0}') AS headline
+FROM thread_messages m JOIN threads ON threads.thread_id = m.thread
+WHERE m.message_id = ANY($2::bigint[]);
+""".format(HEADLINE_OPTIONS)
 
 
 class Result:
@@ -79,44 +64,274 @@ class Result:
         self.message_id = message_id
 
     def format_result(self):
-        message = self.message.replace('*', '').replace('_', '')
-        if len(message) > 20:
-            message = message[:20]
-        return '[{0}](https://discord.com/channels/{1}/{2}/{3}) ...{4}...'.format(self.thread.title, self.thread.guild.id, self.thread.thread_id, self.message_id, message)
+        message = discord.utils.escape_markdown(' '.join(self.message.split()))
+        message = message.replace(HIGHLIGHT_START, '**').replace(HIGHLIGHT_STOP, '**')
+        return '[{0}](https://discord.com/channels/{1}/{2}/{3}) ...{4}...'.format(
+            discord.utils.escape_markdown(self.thread.title), self.thread.guild.id, self.thread.thread_id, self.message_id, message,
+        )
 
 
 class QueryResult:
 
-    def __init__(self, results: list[Result]):
+    def __init__(self, results: list[Result], *, page: int = 0, pages: int = 1):
         self.results = results
+        self.page = page
+        self.pages = pages
+
+    @property
+    def more(self) -> bool:
+        return self.page + 1 < self.pages
 
     def format_result(self) -> Embed:
         embed = Embed()
-        embed.description = '\n'.join([t.format_result() for t in self.results if t.thread.public])
+        embed.description = '\n'.join([t.format_result() for t in self.results])
         if not embed.description:
             embed.description = 'None found!'
+        embed.set_footer(text='Page {0} of {1}'.format(self.page + 1, max(self.pages, 1)))
         return embed
 
 
+class SearchCache:
+    """
+    Rank orders keyed by tsquery and pages of results keyed by ``(tsquery, order generation, page, page size)``. Least
+    recently used entries are evicted first and every entry expires after ``ttl`` seconds.
+
+    An order is stored with the generation it was read at and pages are keyed by it, so a search that is still paging
+    through an order from before an invalidation never mixes its pages with ones of a newer order.
+
+    Entries are dropped early when new messages match their query, and pages when a thread in them is deleted.
+    """
+
+    def __init__(self, capacity: int, ttl: float):
+        self.ttl = ttl
+        self.pages: LRU = LRU(capacity)
+        self.orders: LRU = LRU(capacity)
+        # User input (with case and spacing normalized) -> tsquery text
+        self.tsqueries: LRU = LRU(capacity)
+        self.hits = 0
+        self.misses = 0
+        # Goes up on every invalidation. A page is only cached if nothing was invalidated while it was being fetched,
+        # otherwise it could have been read from before the change.
+        self.generation = 0
+
+    def _get(self, store: LRU, key):
+        entry = store.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def _put(self, store: LRU, key, value, generation: int):
+        if generation != self.generation:
+            return
+        store[key] = (time.monotonic() + self.ttl, value)
+
+    def get(self, key) -> Optional[QueryResult]:
+        return self._get(self.pages, key)
+
+    def put(self, key, result: QueryResult, generation: int):
+        self._put(self.pages, key, result, generation)
+
+    def get_order(self, tsquery) -> Optional[tuple[int, list[int]]]:
+        """The generation an order was read at and its ids"""
+        return self._get(self.orders, tsquery)
+
+    def put_order(self, tsquery, order: list[int], generation: int):
+        self._put(self.orders, tsquery, (generation, order), generation)
+
+    def queries(self) -> set[str]:
+        return {key[0] for key in self.pages.keys()} | set(self.orders.keys())
+
+    def invalidate(self, tsqueries: set[str]):
+        self.generation += 1
+        for key in list(self.pages.keys()):
+            if key[0] in tsqueries:
+                del self.pages[key]
+        for tsquery in tsqueries:
+            if tsquery in self.orders:
+                del self.orders[tsquery]
+
+    def invalidate_thread(self, thread_id):
+        self.generation += 1
+        for key, (_, result) in list(self.pages.items()):
+            if any(r.thread.thread_id == thread_id for r in result.results):
+                del self.pages[key]
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        return '{0}/{1} pages, {2} queries, {3} hits, {4} misses ({5:.1f}% hit rate)'.format(
+            len(self.pages), self.pages.get_size(), len(self.orders), self.hits, self.misses,
+            self.hits / lookups * 100 if lookups else 0,
+        )
+
+
+class SearchQuery:
+    """
+    A full text search over thread messages, a page at a time.
+    """
+
+    def __init__(self, bot: Mikro, query: str, cache: SearchCache, *, page_size: int = PAGE_SIZE):
+        self.bot = bot
+        self.query = query
+        self.cache = cache
+        self.page_size = page_size
+        self.tsquery: Optional[str] = None
+        self.order: Optional[list[int]] = None
+        self.order_generation = 0
+
+    async def fetch(self, page: int = 0) -> QueryResult:
+        """
+        A page of results. The first page of a search without a cached order is read in a single round trip, every
+        page after comes from the order it got.
+        """
+        if self.order is None:
+            normalized = ' '.join(self.query.casefold().split())
+            tsquery = self.cache.tsqueries.get(normalized)
+            if tsquery == '':
+                # Nothing but stop words
+                return QueryResult([], page=page)
+            cached = self.cache.get_order(tsquery) if tsquery is not None else None
+            if cached is None:
+                return await self._search(normalized, page)
+            self.tsquery = tsquery
+            self.order_generation, self.order = cached
+        key = (self.tsquery, self.order_generation, page, self.page_size)
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+        generation = self.cache.generation
+        ids = self.order[page * self.page_size:(page + 1) * self.page_size]
+        async with db.MaybeAcquire(pool=self.bot.pool) as con:
+            rows = await con.fetch(PAGE, self.tsquery, ids)
+        result = self._result(rows, ids, page)
+        self.cache.put(key, result, generation)
+        return result
+
+    async def _search(self, normalized: str, page: int) -> QueryResult:
+        generation = self.cache.generation
+        start = page * self.page_size
+        async with db.MaybeAcquire(pool=self.bot.pool) as con:
+            rows = await con.fetch(SEARCH, normalized, MAX_RESULTS, start, start + self.page_size)
+        self.tsquery = rows[0]['query_text']
+        self.cache.tsqueries[normalized] = self.tsquery
+        self.order = list(rows[0]['ids'])
+        self.order_generation = generation
+        if not self.tsquery:
+            return QueryResult([], page=page)
+        self.cache.put_order(self.tsquery, self.order, generation)
+        result = self._result([r for r in rows if r['message_id'] is not None], self.order[start:start + self.page_size], page)
+        self.cache.put((self.tsquery, generation, page, self.page_size), result, generation)
+        return result
+
+    def _result(self, rows, ids: list[int], page: int) -> QueryResult:
+        """Puts rows of a page back in rank order"""
+        rows = {r['message_id']: r for r in rows}
+        registry = self.bot.thread_handler.registry
+        results = []
+        for message_id in ids:
+            r = rows.get(message_id)
+            if r is None:
+                # Deleted since it was ranked
+                continue
+            # Threads come joined onto every row, what's in memory is just as new or newer
+            thread = registry.get(r['thread']) or ThreadData.from_query(self.bot, r)
+            results.append(Result(thread, r['headline'], r['message_id']))
+        return QueryResult(results, page=page, pages=-(-len(self.order) // self.page_size))
+
+
+class SearchView(discord.ui.View):
+
+    def __init__(self, search: SearchQuery, result: QueryResult, owner_id: int):
+        super().__init__(timeout=180)
+        self.search = search
+        self.result = result
+        self.owner_id = owner_id
+        self.message: Optional[discord.Message] = None
+        self.update_buttons()
+
+    def update_buttons(self):
+        self.previous_page.disabled = self.result.page == 0
+        self.next_page.disabled = not self.result.more
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if interaction.user.id != self.owner_id:
+            await interaction.response.send_message("This isn't your search!", ephemeral=True)
+            return False
+        return True
+
+    async def show(self, interaction: discord.Interaction, page):
+        self.result = await self.search.fetch(page)
+        self.update_buttons()
+        await interaction.response.edit_message(embed=self.result.format_result(), view=self)
+
+    @discord.ui.button(label='Previous', style=discord.ButtonStyle.grey)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, self.result.page - 1)
+
+    @discord.ui.button(label='Next', style=discord.ButtonStyle.grey)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, self.result.page + 1)
+
+    async def on_timeout(self) -> None:
+        if self.message is not None:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
+
+
 class Search(commands.Cog):
 
     def __init__(self, bot: Mikro):
         self.bot: Mikro = bot
+        self.cache = SearchCache(
+            bot_global.config.get('search_cache_size', 256),
+            bot_global.config.get('search_cache_seconds', 300),
+        )
+
+    async def cog_load(self) -> None:
+        self.bot.thread_handler.indexer.add_commit_hook(self.invalidate_matching)
+
+    async def cog_unload(self) -> None:
+        handler = self.bot.thread_handler
+        if handler is not None:
+            handler.indexer.remove_commit_hook(self.invalidate_matching)
+
+    async def invalidate_matching(self, records):
+        """Drops cached pages of every query that one of the just indexed messages matches"""
+        queries = self.cache.queries()
+        matched = set()
+        if queries:
+            # Matched against the tsvectors the indexer just stored instead of parsing every message again per query
+            command = 'SELECT q FROM unnest($1::text[]) q WHERE EXISTS (' \
+                      'SELECT 1 FROM thread_messages m WHERE m.message_id = ANY($2::bigint[]) AND m.message_content_tsv @@ q::tsquery);'
+            async with db.MaybeAcquire(pool=self.bot.pool) as con:
+                rows = await con.fetch(command, list(queries), [record[1] for record in records])
+            matched = {row['q'] for row in rows}
+        # Even with nothing cached yet, searches that are running could have read from before the commit
+        self.cache.invalidate(matched)
+
+    @commands.Cog.listener()
+    async def on_raw_thread_delete(self, payload: discord.RawThreadDeleteEvent):
+        self.cache.invalidate_thread(payload.thread_id)
+
+    @commands.is_owner()
+    @commands.command(name='searchcache')
+    async def search_cache(self, ctx: Context):
+        await ctx.send(str(self.cache), ephemeral=True)
 
     @commands.command(name='search')
     async def search_command(self, ctx: Context, *, query: str):
         if ctx.guild is None or ctx.guild.id != 753693459369427044:
             return
-        q = Query([PARAMETERS['content'].copy(query)])
-        results = {}
-        async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            for table, q in q.get_queries().items():
-                results[table] = await con.fetch(q[0], *q[1])
-        format_result = []
-        for r in results['thread_messages']:
-            format_result.append(Result(await self.bot.thread_handler.get_thread(r['thread']), r['message_content'], r['message_id']))
-        qr = QueryResult(format_result)
-        await ctx.send(embed=qr.format_result())
+        search = SearchQuery(self.bot, query, self.cache)
+        result = await search.fetch()
+        if not result.more:
+            await ctx.send(embed=result.format_result())
+            return
+        view = SearchView(search, result, ctx.author.id)
+        view.message = await ctx.send(embed=result.format_result(), view=view)
 
 
 async def setup(bot):
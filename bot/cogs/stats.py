@@ -1,14 +1,20 @@
+import asyncio
+import bisect
+import logging
 import random
+import time
+from array import array
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Awaitable, Callable, Optional
 
 import discord
 from discord.ext import commands
 
+import bot as bot_global
 from bot.core.context import Context
 from bot.core.embed import Embed
 from bot.mikro import Mikro
-from bot.util import database as db, cache
+from bot.util import database as db, cache, activity, bulk, wal
 from bot.util import time_util
 from enum import Enum
 
@@ -20,34 +26,88 @@ class MessageType(Enum):
     attachment = 2
 
 
-class Messages(db.Table, table_name='messages'):
-    guild_id = db.Column(db.Integer(big=True), index=True)
-    channel_id = db.Column(db.Integer(big=True), index=True)
-    user_id = db.Column(db.Integer(big=True), index=True)
+class Messages(db.Table, table_name='messages', partition=db.RangePartition('message_id', interval='day', retention=7, snowflake=True)):
+    # The time is encoded in message_id, see db.snowflake_time_sql
+    guild_id = db.Column(db.Integer(big=True))
+    channel_id = db.Column(db.Integer(big=True))
+    user_id = db.Column(db.Integer(big=True))
     message_id = db.Column(db.Integer(big=True), unique=True)
-    time = db.Column(db.Datetime(), default="now() at time zone 'utc'", index=True)
     type = db.Column(db.Integer(small=True))
 
+    @classmethod
+    def create_table(cls, *, overwrite=False):
+        statement = super().create_table(overwrite=overwrite)
+
+        # Time ranges use the unique index on message_id. The BRIN index that used to sit next to it was never chosen.
+        sql = 'DROP INDEX IF EXISTS messages_message_id_brin;' \
+              'CREATE INDEX IF NOT EXISTS messages_guild_message_idx ON messages (guild_id, message_id);'
+
+        return statement + '\n' + sql
 
-class MessageCooldown(db.Table, table_name='message_cooldown'):
-    guild_id = db.Column(db.Integer(big=True), index=True)
-    channel_id = db.Column(db.Integer(big=True), index=True)
-    user_id = db.Column(db.Integer(big=True), index=True)
-    time = db.Column(db.Datetime(), default="now() at time zone 'utc'")
+
+class MessageActivity(db.Table, table_name='message_activity'):
+    guild_id = db.Column(db.Integer(big=True))
+    channel_id = db.Column(db.Integer(big=True))
+    user_id = db.Column(db.Integer(big=True))
     period = db.Column(db.Interval())
-    amount = db.Column(db.Integer(), default='1')
+    time = db.Column(db.Datetime())
+    buckets = db.Column(db.Array(db.Integer()))
 
     @classmethod
     def create_table(cls, *, overwrite=False):
         statement = super().create_table(overwrite=overwrite)
 
         # create constraints
-        sql = 'ALTER TABLE message_cooldown DROP CONSTRAINT IF EXISTS unique_cool;' \
-              'ALTER TABLE message_cooldown ADD CONSTRAINT unique_cool UNIQUE (guild_id, channel_id, user_id, period);'
+        sql = 'DROP TABLE IF EXISTS message_cooldown;' \
+              'ALTER TABLE message_activity DROP CONSTRAINT IF EXISTS unique_activity;' \
+              'ALTER TABLE message_activity ADD CONSTRAINT unique_activity UNIQUE (guild_id, channel_id, user_id, period);'
 
         return statement + '\n' + sql
 
 
+class MessageRollup(db.Table, table_name='message_rollup'):
+    guild_id = db.Column(db.Integer(big=True))
+    channel_id = db.Column(db.Integer(big=True))
+    user_id = db.Column(db.Integer(big=True))
+    hour = db.Column(db.Datetime(), index=True)
+    simple = db.Column(db.Integer(), default='0')
+    long = db.Column(db.Integer(), default='0')
+    attachment = db.Column(db.Integer(), default='0')
+
+    @classmethod
+    def create_table(cls, *, overwrite=False):
+        statement = super().create_table(overwrite=overwrite)
+
+        # create constraints
+        sql = 'ALTER TABLE message_rollup DROP CONSTRAINT IF EXISTS unique_rollup;' \
+              'ALTER TABLE message_rollup ADD CONSTRAINT unique_rollup UNIQUE (guild_id, channel_id, user_id, hour);' \
+              'CREATE INDEX IF NOT EXISTS message_rollup_guild_hour_idx ON message_rollup (guild_id, hour);'
+
+        # Backfill from raw messages the first time the rollup is created
+        hour = "date_trunc('hour', {0})".format(db.snowflake_time_sql('message_id'))
+        backfill = "INSERT INTO message_rollup(guild_id, channel_id, user_id, hour, simple, long, attachment) " \
+                   "SELECT guild_id, channel_id, user_id, {0}, " \
+                   "count(*) FILTER (WHERE type = 0), count(*) FILTER (WHERE type = 1), count(*) FILTER (WHERE type = 2) " \
+                   "FROM messages WHERE NOT EXISTS (SELECT 1 FROM message_rollup) " \
+                   "GROUP BY guild_id, channel_id, user_id, {0};".format(hour)
+
+        return statement + '\n' + sql + '\n' + backfill
+
+    @staticmethod
+    def update_statement(staging):
+        """Adds every staged message that isn't in ``messages`` yet to its hourly bucket."""
+        return "INSERT INTO message_rollup(guild_id, channel_id, user_id, hour, simple, long, attachment) " \
+               "SELECT s.guild_id, s.channel_id, s.user_id, date_trunc('hour', {1}), " \
+               "count(*) FILTER (WHERE s.type = 0), count(*) FILTER (WHERE s.type = 1), count(*) FILTER (WHERE s.type = 2) " \
+               "FROM (SELECT DISTINCT ON (message_id) * FROM {0}) s " \
+               "WHERE NOT EXISTS (SELECT 1 FROM messages m WHERE m.message_id = s.message_id) " \
+               "GROUP BY s.guild_id, s.channel_id, s.user_id, date_trunc('hour', {1}) " \
+               "ON CONFLICT ON CONSTRAINT unique_rollup DO UPDATE SET " \
+               "simple = message_rollup.simple + EXCLUDED.simple, " \
+               "long = message_rollup.long + EXCLUDED.long, " \
+               "attachment = message_rollup.attachment + EXCLUDED.attachment;".format(staging, db.snowflake_time_sql('s.message_id'))
+
+
 class Message:
 
     def __init__(self, guild_id, channel_id, author_id, message_id, time: datetime, type: MessageType):
@@ -63,6 +123,9 @@ class Message:
             self.guild_id, self.channel_id, self.author_id, self.message_id, self.time.strftime("'%Y-%m-%d %H:%M:%S'"), self.type.value
         )
 
+    def to_record(self) -> tuple:
+        return self.guild_id, self.channel_id, self.author_id, self.message_id, self.type.value
+
     def __eq__(self, other):
         if not isinstance(other, Message):
             return False
@@ -76,61 +139,97 @@ class Message:
         author_id = author_id or data['author_id']
         guild_id = guild_id or data['guild_id']
         channel_id = channel_id or data['channel_id']
-        return Message(guild_id, channel_id, author_id, data['message_id'], data['time'], MessageType(data['type']))
+        time = data.get('time') or discord.utils.snowflake_time(data['message_id']).replace(tzinfo=None)
+        return Message(guild_id, channel_id, author_id, data['message_id'], time, MessageType(data['type']))
 
 
 class MessagePeriod:
+    """
+    Messages from the last ``minutes`` minutes, ordered by time.
+
+    Only the message id and timestamp are kept, in two parallel arrays. Expired messages are evicted from the head by
+    moving an offset, and the arrays are compacted once more than half of them is dead, so eviction is amortized O(1).
+    """
 
     def __init__(self, minutes, *, messages: Optional[list[Message]] = None):
-        self._messages: list[Message] = messages or []
         self.minutes = minutes
+        self._ids = array('q')
+        self._times = array('d')
+        self._head = 0
+        if messages:
+            self.extend(messages)
 
     def __iter__(self):
         self._verify_integrity()
-        dup = self._messages.copy()
-        for m in dup:
-            # Yield could have weird waiting implications
-            # Also don't want to have concurrent modification exception
-            if self._message_valid(m):
-                yield m
+        # Snapshot the bounds so appending while iterating doesn't matter
+        ids, times = self._ids[self._head:], self._times[self._head:]
+        for message_id, time in zip(ids, times):
+            yield message_id, activity.from_epoch(time)
 
     def __len__(self):
         self._verify_integrity()
-        return len(self._messages)
+        return len(self._ids) - self._head
 
     def append(self, message: Message):
-        self._messages.append(message)
+        self._insert(message.message_id, activity.to_epoch(message.time))
         self._verify_integrity()
 
     def extend(self, messages: list[Message]):
-        self._messages.extend(messages)
+        for m in messages:
+            self._insert(m.message_id, activity.to_epoch(m.time))
         self._verify_integrity()
 
     def remove(self, message: Message):
-        self._messages.remove(message)
+        for i in range(self._head, len(self._ids)):
+            if self._ids[i] == message.message_id:
+                del self._ids[i]
+                del self._times[i]
+                return
+        raise ValueError('{0} is not in MessagePeriod'.format(message.message_id))
 
     def __add__(self, other):
         if isinstance(other, MessagePeriod):
-            self._messages.extend(other._messages)
+            for message_id, time in zip(other._ids[other._head:], other._times[other._head:]):
+                self._insert(message_id, time)
+            self._verify_integrity()
             return self
         if isinstance(other, list):
-            self._messages.extend(other)
+            self.extend(other)
             return self
         if isinstance(other, Message):
-            self._messages.append(other)
+            self.append(other)
             return self
         raise TypeError('Cannot add {0} to MessagePeriod'.format(other))
 
     def __getitem__(self, item):
         self._verify_integrity()
-        return self._messages[item]
-
-    def _message_valid(self, x: Message):
-        now = time_util.get_utc()
-        return (x.time - now).total_seconds() / 60 > self.minutes
+        if isinstance(item, slice):
+            return list(zip(self._ids[self._head:][item], map(activity.from_epoch, self._times[self._head:][item])))
+        if item < 0:
+            item += len(self._ids) - self._head
+        if item < 0 or item >= len(self._ids) - self._head:
+            raise IndexError('MessagePeriod index out of range')
+        return self._ids[self._head + item], activity.from_epoch(self._times[self._head + item])
+
+    def _insert(self, message_id: int, time: float):
+        if not self._times or self._times[-1] <= time:
+            self._ids.append(message_id)
+            self._times.append(time)
+            return
+        # Out of order messages are rare, so a shift is fine here
+        index = bisect.bisect_right(self._times, time, lo=self._head)
+        self._ids.insert(index, message_id)
+        self._times.insert(index, time)
 
     def _verify_integrity(self):
-        self._messages = list(filter(lambda x: self._message_valid(x), self._messages))
+        cutoff = activity.to_epoch(time_util.get_utc()) - self.minutes * 60
+        size = len(self._times)
+        while self._head < size and self._times[self._head] < cutoff:
+            self._head += 1
+        if self._head and self._head * 2 >= size:
+            del self._ids[:self._head]
+            del self._times[:self._head]
+            self._head = 0
 
 
 class CooldownInterval(Enum):
@@ -156,31 +255,121 @@ class CooldownInterval(Enum):
             return CooldownInterval.hours_24
         return None
 
+    @property
+    def delta(self) -> timedelta:
+        amount, unit = self.value.split(' ')
+        return timedelta(**{unit.lower(): int(amount)})
+
+
+class Consumer:
+    """
+    Something that receives every tracked message from :class:`Stats`, with its own timeout and latency counters.
+    """
+
+    def __init__(self, name, function: Callable[[Message, discord.Message], Awaitable[None]], *, timeout: float = 5):
+        self.name = name
+        self.function = function
+        self.timeout = timeout
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.timeouts = 0
+        self.errors = 0
+
+    @property
+    def average_time(self) -> float:
+        if self.calls == 0:
+            return 0
+        return self.total_time / self.calls
+
+    async def __call__(self, message: Message, original: discord.Message):
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.function(message, original), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logging.warning('Message consumer {0} timed out after {1} seconds'.format(self.name, self.timeout))
+        except Exception:   # noqa: E722
+            self.errors += 1
+            logging.exception('Message consumer {0} failed'.format(self.name))
+        finally:
+            elapsed = time.perf_counter() - start
+            self.calls += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
 
 class Stats(commands.Cog):
 
     def __init__(self, bot):
         self.bot: Mikro = bot
         self.bot.add_loop('messagepush', self.update_loop)
-        self.cache: list[Message] = []
+        self.writer = bulk.BulkWriter(
+            self.bot.pool,
+            'messages',
+            ('guild_id', 'channel_id', 'user_id', 'message_id', 'type'),
+            flush_size=bot_global.config.get('stats_flush_size', 500),
+            flush_interval=bot_global.config.get('stats_flush_interval', 300),
+            max_size=bot_global.config.get('stats_buffer_size', 10000),
+            wal=wal.WriteAheadLog(bot_global.config.get('wal_directory', 'config/wal'), 'messages'),
+        )
+        self.writer.add_flush_hook(self.update_rollup)
+        self.consumers: dict[str, Consumer] = {}
+        self.add_consumer('tree', self._tree_consumer)
+        self.add_consumer('thread_discovery', self._thread_discovery_consumer)
         self.cooldown = cache.ExpiringDict(seconds=20)
+        self.activity = activity.ActivityCounter({interval: interval.delta for interval in CooldownInterval})
+
+    def add_consumer(self, name, function: Callable[[Message, discord.Message], Awaitable[None]], *, timeout: float = 5):
+        """Registers a coroutine that gets called concurrently with the others for every tracked message."""
+        self.consumers[name] = Consumer(name, function, timeout=timeout)
+
+    def remove_consumer(self, name):
+        self.consumers.pop(name, None)
+
+    async def _tree_consumer(self, message: Message, original: discord.Message):
+        tree = self.bot.get_cog('Tree')
+        if tree is not None:
+            await tree.on_message(message)
+
+    async def _thread_discovery_consumer(self, message: Message, original: discord.Message):
+        discovery = self.bot.get_cog('ThreadDiscovery')
+        if discovery is not None:
+            await discovery.on_message(original)
+
+    async def cog_load(self) -> None:
+        await self.load_activity()
+        await self.writer.start()
 
     async def update_loop(self, time: datetime):
         if time.minute % 5 == 0:
-            await self.push()
+            await self.push_activity()
         if time.minute == 0 and time.hour == 0:
             await self.remove_old()
             if time.weekday() % 2 == 0:
                 await self.update_top()
 
     async def cog_unload(self) -> None:
-        await self.push()
+        await self.writer.close()
+        await self.push_activity()
+
+    async def update_rollup(self, con, staging, records):
+        await con.execute(MessageRollup.update_statement(staging))
+
+    async def get_top_users(self, guild_id, *, since: timedelta, limit=10, channel_id=None):
+        """
+        Returns ``(user_id, amount)`` rows ordered by amount of messages, read from the hourly rollup.
+        """
+        command = "SELECT user_id, sum(simple + long + attachment) amount FROM message_rollup " \
+                  "WHERE guild_id = $1 AND hour >= date_trunc('hour', NOW() at time zone 'utc' - $2::interval) " \
+                  "AND ($3::bigint IS NULL OR channel_id = $3) " \
+                  "GROUP BY user_id ORDER BY amount DESC LIMIT $4;"
+        async with db.MaybeAcquire(pool=self.bot.pool) as con:
+            return await con.fetch(command, guild_id, since, channel_id, limit)
 
     async def update_top(self):
-        command = "SELECT user_id, count(*) amount FROM messages WHERE time >= NOW() at time zone 'utc' - interval '1 WEEKS' AND guild_id = 753693459369427044 " \
-                  "group by user_id order by count(*) desc;"
-        async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            rows = await con.fetch(command)
+        # Fetch a few extra in case some have left
+        rows = await self.get_top_users(753693459369427044, since=timedelta(weeks=1), limit=20)
         if not rows:
             return
         message = []
@@ -207,6 +396,18 @@ class Stats(commands.Cog):
         await self.update_top()
         await ctx.send("Done!", ephemeral=True)
 
+    @commands.is_owner()
+    @commands.command(name="consumerstats")
+    async def consumer_stats(self, ctx: Context):
+        lines = []
+        for consumer in sorted(self.consumers.values(), key=lambda c: c.total_time, reverse=True):
+            lines.append('`{0}` {1} calls, {2:.1f}ms avg, {3:.1f}ms max, {4} timeouts, {5} errors'.format(
+                consumer.name, consumer.calls, consumer.average_time * 1000, consumer.max_time * 1000, consumer.timeouts, consumer.errors,
+            ))
+        embed = Embed()
+        embed.set_description('\n'.join(lines) or 'No consumers')
+        await ctx.send(embed=embed, ephemeral=True)
+
     @commands.Cog.listener()
     async def on_member_remove(self, member: discord.Member):
         start = member.joined_at
@@ -235,70 +436,68 @@ class Stats(commands.Cog):
         else:
             type = MessageType.simple
         sm = Message(message.guild.id, message.channel.id, message.author.id, message.id, time_util.get_utc(), type)
-        await self.bot.get_cog('Tree').on_message(sm)
-        await self.bot.get_cog('ThreadDiscovery').on_message(message)
-        self.cache.append(sm)
+        await asyncio.gather(*(consumer(sm, message) for consumer in self.consumers.values()))
+        # Counters are updated after so consumers see activity from before this message
         await self.update_interval(sm)
+        await self.writer.put(sm.to_record())
+
+    def get_activity(self, guild_id, *, channel_id=0, user_id=0) -> dict[CooldownInterval, int]:
+        """Messages sent in every interval, straight from memory"""
+        return self.activity.get_all((guild_id, channel_id, user_id))
 
     async def get_messages_in_cooldowns(self, guild_id, *, channel_id=0, user_id=0) -> dict[CooldownInterval, int]:
-        command = "DELETE FROM message_cooldown WHERE now() at time zone 'utc' >= time + period;"
-        fetch = "SELECT period, amount FROM message_cooldown WHERE guild_id = {0} and channel_id = {1} and user_id = {2};"\
-            .format(guild_id, channel_id, user_id)
-        async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            await con.execute(command)
-            rows = await con.fetch(fetch)
-        data = {}
-        if rows:
-            for r in rows:
-                data[CooldownInterval.from_delta(r['period'])] = r['amount']
-        return data
+        return self.get_activity(guild_id, channel_id=channel_id, user_id=user_id)
 
     async def get_messages_in_cooldown(self, guild_id, *, channel_id=None, user_id=None, interval: CooldownInterval) -> int:
         if channel_id is None:
             channel_id = 0
         if user_id is None:
             user_id = 0
-        command = "DELETE FROM message_cooldown WHERE now() at time zone 'utc' >= time + period;"
-        fetch = "SELECT amount FROM message_cooldown WHERE guild_id = {0} and channel_id = {1} and user_id = {2} " \
-                "and period = INTERVAL '{3}';".format(guild_id, channel_id, user_id, interval.value)
-        async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            await con.execute(command)
-            row = await con.fetchrow(fetch)
-        if row:
-            return row['amount']
-        return 0
+        return self.activity.get((guild_id, channel_id, user_id), interval)
 
     async def update_interval(self, message: Message):
-        command = 'INSERT INTO message_cooldown(guild_id, channel_id, user_id, period) VALUES {0} ' \
-                  'ON CONFLICT ON CONSTRAINT unique_cool DO UPDATE SET amount = message_cooldown.amount + 1;'
-        val = "({0}, {1}, {2}, INTERVAL '{3}')"
-        values = []
-        for interval in CooldownInterval:
-            values.append(val.format(message.guild_id, message.channel_id, message.author_id, interval.value))
-        for interval in CooldownInterval:
-            values.append(val.format(message.guild_id, message.channel_id, 0, interval.value))
-        for interval in CooldownInterval:
-            values.append(val.format(message.guild_id, 0, message.author_id, interval.value))
-        command = command.format(', '.join(values))
-        async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            await con.execute(command)
+        now = self.activity.now()
+        self.activity.add((message.guild_id, message.channel_id, message.author_id), now=now)
+        self.activity.add((message.guild_id, message.channel_id, 0), now=now)
+        self.activity.add((message.guild_id, 0, message.author_id), now=now)
 
-    async def remove_old(self):
-        interval = f"INTERVAL '7 DAYS'"
-        command = f"DELETE FROM messages WHERE time <= NOW() at time zone 'utc' - {interval};"
+    async def load_activity(self):
+        command = 'SELECT guild_id, channel_id, user_id, period, time, buckets FROM message_activity;'
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            await con.execute(command)
-
-    async def push(self):
-        if len(self.cache) == 0:
+            rows = await con.fetch(command)
+        now = self.activity.now()
+        for r in rows:
+            interval = CooldownInterval.from_delta(r['period'])
+            if interval is None:
+                continue
+            self.activity.load((r['guild_id'], r['channel_id'], r['user_id']), interval, r['time'], r['buckets'], now=now)
+        # Anything that expired while offline shouldn't be in the database anymore
+        await self.push_activity()
+
+    async def push_activity(self):
+        now = self.activity.now()
+        removed = [tuple(key) for key in self.activity.cleanup(now=now)]
+        values = [
+            (*key, interval.delta, head_start, buckets) for key, interval, head_start, buckets in self.activity.pop_dirty(now=now)
+        ]
+        if not removed and not values:
             return
-        insert = [str(m) for m in self.cache]
+        delete = 'DELETE FROM message_activity WHERE guild_id = $1 AND channel_id = $2 AND user_id = $3;'
+        command = 'INSERT INTO message_activity(guild_id, channel_id, user_id, period, time, buckets) VALUES ($1, $2, $3, $4, $5, $6) ' \
+                  'ON CONFLICT ON CONSTRAINT unique_activity DO UPDATE SET time = EXCLUDED.time, buckets = EXCLUDED.buckets;'
+        async with db.MaybeAcquire(pool=self.bot.pool) as con:
+            async with con.transaction():
+                if removed:
+                    await con.executemany(delete, removed)
+                if values:
+                    await con.executemany(command, values)
 
-        command = 'INSERT INTO messages(guild_id, channel_id, user_id, message_id, time, type) VALUES {0} ON CONFLICT DO NOTHING;'
-        command = command.format(', '.join(insert))
+    async def remove_old(self):
+        # Retention is handled by dropping whole days instead of deleting rows
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            await con.execute(command)
-        self.cache.clear()
+            await Messages.create_partitions(connection=con)
+            await Messages.drop_partitions(connection=con)
+            await con.execute("DELETE FROM message_rollup WHERE hour < NOW() at time zone 'utc' - INTERVAL '90 DAYS';")
 
 
 async def setup(bot):
@@ -1,18 +1,21 @@
 from __future__ import annotations
 
 import asyncio
+import functools
 import logging
-from typing import Optional, TYPE_CHECKING
+from typing import Any, Optional, TYPE_CHECKING
 
 import discord
 import toml
 from discord.ext import commands
+from lru import LRU
 
+import bot as bot_global
 from bot.core.context import Context
 
 if TYPE_CHECKING:
     from bot.mikro import Mikro
-from bot.util import cache
+from bot.util import bulk, locks, pacer, wal
 import re
 from bot.util import database as db
 from tqdm import tqdm
@@ -31,6 +34,22 @@ class Threads(db.Table, table_name='threads'):
     description = db.Column(db.String(), nullable=True)
     disable_archive = db.Column(db.Boolean(), default='FALSE')
     public = db.Column(db.Boolean(), default='TRUE')
+    # Last message the history backfill wrote, and whether everything up to the thread's last message is stored
+    history_until = db.Column(db.Integer(big=True))
+    history_synced = db.Column(db.Boolean(), default='FALSE')
+
+    @classmethod
+    def create_table(cls, *, overwrite=False):
+        statement = super().create_table(overwrite=overwrite)
+
+        # Existing rows start from what was already backfilled
+        sql = "DO $$ BEGIN " \
+              "IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name = 'threads' AND column_name = 'history_until') THEN " \
+              "ALTER TABLE threads ADD COLUMN history_until BIGINT, ADD COLUMN history_synced BOOLEAN DEFAULT FALSE; " \
+              "UPDATE threads SET history_until = last_message_id; " \
+              "END IF; END $$;"
+
+        return statement + '\n' + sql
 
 
 class ThreadMessages(db.Table, table_name='thread_messages'):
@@ -50,6 +69,34 @@ class ThreadMessages(db.Table, table_name='thread_messages'):
         return statement + '\n' + sql
 
 
+class ThreadCrawl(db.Table, table_name='thread_crawl'):
+
+    channel_id = db.Column(db.Integer(big=True))
+    private = db.Column(db.Boolean())
+    # When the crawl in progress started, and the archive time of the oldest thread it has seen so far
+    started = db.Column(db.Datetime(timezone=True))
+    cursor = db.Column(db.Datetime(timezone=True), nullable=True)
+    # Start of the last complete crawl. Every thread archived before this is already stored.
+    synced_until = db.Column(db.Datetime(timezone=True), nullable=True)
+
+    @classmethod
+    def create_table(cls, *, overwrite=False):
+        statement = super().create_table(overwrite=overwrite)
+
+        # create constraints
+        sql = 'ALTER TABLE thread_crawl DROP CONSTRAINT IF EXISTS unique_crawl;' \
+              'ALTER TABLE thread_crawl ADD CONSTRAINT unique_crawl UNIQUE (channel_id, private);'
+
+        return statement + '\n' + sql
+
+
+# Archived threads Discord returns per request
+CRAWL_PAGE = 100
+CRAWL_RETRIES = 5
+# Messages written per transaction when backfilling history
+HISTORY_CHUNK = 500
+
+
 class ThreadData:
 
     def __init__(self, guild: discord.Guild, thread_id, channel_id, owner_id, title, starting_message, tags, description, disable_archive, public, last_message_id):
@@ -64,6 +111,8 @@ class ThreadData:
         self.disable_archive: bool = disable_archive
         self.public: bool = public
         self.last_message_id = last_message_id
+        # Set once the registry holds this, updates are written through it
+        self.registry: Optional[ThreadRegistry] = None
 
     @classmethod
     def from_query(cls, bot: Mikro, row):
@@ -89,35 +138,28 @@ class ThreadData:
     def __hash__(self):
         return hash(self.thread_id)
 
-    async def update_title(self, title, pool):
-        self.title = title
-        async with db.MaybeAcquire(pool=pool) as con:
-            await con.execute('UPDATE threads SET title=$1 WHERE thread_id = $2;', self.title, self.thread_id)
+    async def _update(self, **values):
+        for column, value in values.items():
+            setattr(self, column, value)
+        await self.registry.write(self.thread_id, values)
 
-    async def update_tags(self, tags: list[str], pool):
-        self.tags = tags
-        async with db.MaybeAcquire(pool=pool) as con:
-            await con.execute('UPDATE threads SET tags=$1 WHERE thread_id = $2;', self.tags, self.thread_id)
+    async def update_title(self, title):
+        await self._update(title=title)
 
-    async def update_owner(self, owner_id, pool):
-        self.owner_id = owner_id
-        async with db.MaybeAcquire(pool=pool) as con:
-            await con.execute('UPDATE threads SET owner_id=$1 WHERE thread_id = $2;', self.owner_id, self.thread_id)
+    async def update_tags(self, tags: list[str]):
+        await self._update(tags=tags)
 
-    async def update_description(self, description, pool):
-        self.description = description
-        async with db.MaybeAcquire(pool=pool) as con:
-            await con.execute('UPDATE threads SET description=$1 WHERE thread_id = $2;', self.owner_id, self.thread_id)
+    async def update_owner(self, owner_id):
+        await self._update(owner_id=owner_id)
 
-    async def update_disable_archive(self, disable_archive: bool, pool):
-        self.disable_archive = disable_archive
-        async with db.MaybeAcquire(pool=pool) as con:
-            await con.execute('UPDATE threads SET disable_archive=$1 WHERE thread_id = $2;', self.disable_archive, self.thread_id)
+    async def update_description(self, description):
+        await self._update(description=description)
 
-    async def update_last_message_id(self, last_message_id: int, pool):
-        self.last_message_id = last_message_id
-        async with db.MaybeAcquire(pool=pool) as con:
-            await con.execute('UPDATE threads SET last_message_id=$1 WHERE thread_id = $2;', self.last_message_id, self.thread_id)
+    async def update_disable_archive(self, disable_archive: bool):
+        await self._update(disable_archive=disable_archive)
+
+    async def update_last_message_id(self, last_message_id: int):
+        await self._update(last_message_id=last_message_id)
 
     @classmethod
     async def from_thread(cls, thread: discord.Thread):
@@ -133,6 +175,146 @@ class ThreadData:
         return ThreadData(thread.guild, thread.id, thread.parent.id, thread.owner_id, thread.name, ThreadCommands.get_content(message), [], '', False, ThreadCommands.is_channel_public(thread.parent), thread.last_message_id)
 
 
+def _follow(target: asyncio.Future, source: asyncio.Future):
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    else:
+        target.set_result(None)
+
+
+class ThreadRegistry:
+    """
+    :class:`ThreadData` by thread id, least recently used evicted first.
+
+    Updates change the cached object right away and are written to Postgres in batches. Everything changed while a batch
+    is collecting goes out in one transaction, and each caller waits until the batch with its change is committed. A batch
+    that fails is put back and retried with backoff, so callers only return once their change is written.
+    """
+
+    def __init__(self, pool, capacity: int, *, batch_delay: float = 0.05, retry_delay: float = 1, max_retry_delay: float = 60):
+        self.pool = pool
+        self.batch_delay = batch_delay
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.threads: LRU = LRU(capacity, callback=self._evicted)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pending: dict[int, dict[str, Any]] = {}
+        self._batch: Optional[asyncio.Future] = None
+        self._failures = 0
+        self._flush_tasks: set[asyncio.Task] = set()
+        # Batches are written one at a time so an older one can't commit over a newer one
+        self._lock = asyncio.Lock()
+
+    def _evicted(self, thread_id, data):
+        self.evictions += 1
+
+    def __contains__(self, thread_id) -> bool:
+        return thread_id in self.threads
+
+    def get(self, thread_id) -> Optional[ThreadData]:
+        data = self.threads.get(thread_id)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def add(self, data: ThreadData):
+        data.registry = self
+        self.threads[data.thread_id] = data
+
+    def remove(self, thread_id):
+        if thread_id in self.threads:
+            del self.threads[thread_id]
+        self._pending.pop(thread_id, None)
+
+    async def write(self, thread_id, values: dict[str, Any]):
+        self._pending.setdefault(thread_id, {}).update(values)
+        if self._batch is None:
+            self._batch = asyncio.get_running_loop().create_future()
+            self._schedule(self.batch_delay)
+        await self._batch
+
+    def _schedule(self, delay: float):
+        task = asyncio.create_task(self._flush_later(delay))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def close(self):
+        """Stops waiting on retries and writes everything still pending one last time."""
+        tasks = list(self._flush_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        batch, self._batch = self._batch, None
+        written = await self._flush()
+        if not written:
+            logging.error('Dropped updates to {0} threads'.format(len(self._pending)))
+        if batch is not None and not batch.done():
+            if written:
+                batch.set_result(None)
+            else:
+                batch.cancel()
+
+    async def _flush_later(self, delay: float):
+        await asyncio.sleep(delay)
+        batch, self._batch = self._batch, None
+        written = False
+        try:
+            written = await self._flush()
+        finally:
+            if written:
+                self._failures = 0
+                batch.set_result(None)
+            elif self._batch is None:
+                # Same waiters, they hear back once their changes are in
+                self._batch = batch
+            else:
+                # A newer batch is already collecting and took the changes back with it
+                self._batch.add_done_callback(functools.partial(_follow, batch))
+        if not written:
+            self._failures += 1
+            if self._batch is batch:
+                self._schedule(min(self.retry_delay * 2 ** (self._failures - 1), self.max_retry_delay))
+
+    async def _flush(self) -> bool:
+        """Writes every pending change in one transaction. Failed changes are put back and False is returned."""
+        async with self._lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return True
+            # One statement per column with every thread that changed it
+            columns: dict[str, list[tuple]] = {}
+            for thread_id, values in pending.items():
+                for column, value in values.items():
+                    columns.setdefault(column, []).append((thread_id, value))
+            try:
+                async with db.MaybeAcquire(pool=self.pool) as con:
+                    async with con.transaction():
+                        for column, values in columns.items():
+                            await con.executemany('UPDATE threads SET {0} = $2 WHERE thread_id = $1;'.format(column), values)
+            except BaseException as e:
+                # Newer changes win
+                for thread_id, values in pending.items():
+                    self._pending[thread_id] = {**values, **self._pending.get(thread_id, {})}
+                if not isinstance(e, Exception):
+                    raise
+                logging.exception('Failed writing updates to {0} threads. Retrying.'.format(len(pending)))
+                return False
+            return True
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        return '{0}/{1} threads, {2} hits, {3} misses ({4:.1f}% hit rate), {5} evictions'.format(
+            len(self.threads), self.threads.get_size(), self.hits, self.misses,
+            self.hits / lookups * 100 if lookups else 0, self.evictions,
+        )
+
+
 class ThreadCommands(commands.Cog):
 
     def __init__(self, bot):
@@ -140,11 +322,54 @@ class ThreadCommands(commands.Cog):
         # self.bot.add_loop('update_threads', self.update_threads)
         self.bot.add_on_load(self.update_threads)
         self.setup = False
-        self.lock = asyncio.Lock()
+        # Keyed by thread id. Threads made from a message have the same id as it, so creators can lock before it exists.
+        self.locks = locks.KeyedLock()
+        self.crawl_limit = asyncio.Semaphore(bot_global.config.get('thread_crawl_concurrency', 4))
+        self.pacer = pacer.Pacer(bot_global.config.get('thread_crawl_rate', 4))
+        # Thread messages are searchable once this flushes, so it flushes a lot more often than stats
+        self.indexer = bulk.BulkWriter(
+            self.bot.pool,
+            'thread_messages',
+            ('thread', 'message_id', 'message_content'),
+            derived={'message_content_tsv': 'to_tsvector(message_content)'},
+            flush_size=bot_global.config.get('thread_index_flush_size', 100),
+            flush_interval=bot_global.config.get('thread_index_flush_interval', 5),
+            wal=wal.WriteAheadLog(bot_global.config.get('wal_directory', 'config/wal'), 'thread_messages'),
+        )
+        self.indexer.add_flush_hook(self.update_last_messages)
+        # Every thread id in the threads table. Filled in cog_load and kept up to date wherever threads are stored or deleted.
+        self.known_threads: set[int] = set()
+        self.registry = ThreadRegistry(self.bot.pool, bot_global.config.get('thread_cache_size', 1024))
         self.tag_responses = {}
         with open('./config/tags.toml', 'r') as f:
             self.tag_responses = toml.load(f)
 
+    async def cog_load(self) -> None:
+        async with db.MaybeAcquire(pool=self.bot.pool) as con:
+            rows = await con.fetch('SELECT thread_id FROM threads;')
+        self.known_threads = {row['thread_id'] for row in rows}
+        await self.indexer.start()
+
+    async def cog_unload(self) -> None:
+        await self.registry.close()
+        await self.indexer.close()
+
+    @commands.is_owner()
+    @commands.command(name='threadcache')
+    async def thread_cache(self, ctx: Context):
+        await ctx.send(str(self.registry), ephemeral=True)
+
+    @staticmethod
+    async def update_last_messages(con, staging, records):
+        # Threads can be deleted while their messages are still buffered
+        await con.execute('DELETE FROM {0} s WHERE NOT EXISTS (SELECT 1 FROM threads WHERE thread_id = s.thread);'.format(staging))
+        # One update per thread for the whole batch
+        await con.execute(
+            'UPDATE threads SET last_message_id = s.last_message_id '
+            'FROM (SELECT thread, max(message_id) last_message_id FROM {0} GROUP BY thread) s '
+            'WHERE threads.thread_id = s.thread AND (threads.last_message_id IS NULL OR threads.last_message_id < s.last_message_id);'.format(staging),
+        )
+
     @staticmethod
     def is_channel_public(channel: discord.TextChannel):
         default = channel.guild.default_role
@@ -158,62 +383,156 @@ class ThreadCommands(commands.Cog):
         if time is not None and (not self.setup or time.minute != 0 or time.hour % 6 != 0):
             return
         self.setup = True
-        command = 'INSERT INTO threads(guild_id, thread_id, channel_id, owner_id, title, public) VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT (thread_id) DO UPDATE SET title = EXCLUDED.title, channel_id = EXCLUDED.channel_id;'
-        values = []
         guild = self.bot.get_main_guild()
 
-        guild_threads = []
         # We do a bit of monkey business
         discord.ForumChannel.archived_threads = discord.TextChannel.archived_threads
 
-        for forum in guild.forums:
-            guild_threads.extend(forum.threads)
-            async for thread in forum.archived_threads(limit=None, private=False):
-                guild_threads.append(thread)
-        for channel in guild.text_channels:
-            logging.info('Gathering threads from {0}'.format(channel.name))
-            guild_threads.extend(channel.threads)
-            async for thread in channel.archived_threads(limit=None, private=False):
-                guild_threads.append(thread)
-            if channel.type != discord.ChannelType.news:
-                async for thread in channel.archived_threads(limit=None, private=True):
-                    guild_threads.append(thread)
-
-        for thread in guild_threads:
-            values.append((thread.guild.id, thread.id, thread.parent_id, thread.owner_id, thread.name, self.is_channel_public(thread.parent)))
-        logging.info('Found {0} threads'.format(len(values)))
-        if not values:
+        # Active threads are already cached, only archived ones have to be requested
+        found: dict[int, discord.Thread] = {thread.id: thread for thread in guild.threads}
+        await self.save_threads(list(found.values()))
+        crawls = []
+        for channel in guild.forums + guild.text_channels:
+            crawls.append(self.crawl_archived(channel, False, found))
+            if isinstance(channel, discord.TextChannel) and channel.type != discord.ChannelType.news:
+                crawls.append(self.crawl_archived(channel, True, found))
+        await asyncio.gather(*crawls)
+        logging.info('Found {0} new or active threads'.format(len(found)))
+        logging.info('Finished finding missing threads!')
+        await self.update_blank_start(found)
+        await self.update_history(found)
+
+    async def crawl_archived(self, channel, private: bool, found: dict[int, discord.Thread]):
+        """
+        Stores the archived threads of a channel that aren't stored yet.
+
+        Threads come newest archived first. Each page is committed with a checkpoint, so an interrupted crawl continues
+        from the last page and a finished one only has to go back to when it started next time.
+        """
+        async with self.crawl_limit:
+            async with db.MaybeAcquire(pool=self.bot.pool) as con:
+                row = await con.fetchrow('SELECT started, cursor, synced_until FROM thread_crawl WHERE channel_id = $1 AND private = $2;', channel.id, private)
+            synced_until = row['synced_until'] if row else None
+            if row is not None and row['cursor'] is not None:
+                started, cursor = row['started'], row['cursor']
+            else:
+                started, cursor = discord.utils.utcnow(), None
+            logging.info('Gathering {0} threads from {1}'.format('private' if private else 'public', channel.name))
+            attempt = 0
+            while True:
+                await self.pacer.wait()
+                try:
+                    page = [t async for t in channel.archived_threads(limit=CRAWL_PAGE, before=cursor, private=private)]
+                except discord.Forbidden:
+                    return
+                except discord.HTTPException as e:
+                    if (e.status != 429 and e.status < 500) or attempt >= CRAWL_RETRIES:
+                        logging.warning('Stopped crawling {0}, it will resume next sync'.format(channel.name))
+                        return
+                    attempt += 1
+                    self.pacer.back_off(2 ** attempt)
+                    continue
+                attempt = 0
+                new = [t for t in page if synced_until is None or t.archive_timestamp > synced_until]
+                done = len(page) < CRAWL_PAGE or len(new) < len(page)
+                if page:
+                    cursor = page[-1].archive_timestamp
+                for thread in new:
+                    found[thread.id] = thread
+                async with db.MaybeAcquire(pool=self.bot.pool) as con:
+                    async with con.transaction():
+                        await self.save_threads(new, connection=con)
+                        await con.execute(
+                            'INSERT INTO thread_crawl(channel_id, private, started, cursor, synced_until) VALUES ($1, $2, $3, $4, $5) '
+                            'ON CONFLICT ON CONSTRAINT unique_crawl DO UPDATE SET started = EXCLUDED.started, cursor = EXCLUDED.cursor, synced_until = EXCLUDED.synced_until;',
+                            channel.id, private, started, None if done else cursor, started if done else synced_until,
+                        )
+                if done:
+                    return
+
+    async def save_threads(self, threads: list[discord.Thread], *, connection=None):
+        if not threads:
             return
-        async with db.MaybeAcquire(pool=self.bot.pool) as con:
+        command = 'INSERT INTO threads(guild_id, thread_id, channel_id, owner_id, title, public) VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT (thread_id) DO UPDATE SET title = EXCLUDED.title, channel_id = EXCLUDED.channel_id;'
+        values = [(thread.guild.id, thread.id, thread.parent_id, thread.owner_id, thread.name, self.is_channel_public(thread.parent)) for thread in threads]
+        async with db.MaybeAcquire(connection=connection, pool=self.bot.pool) as con:
             await con.executemany(command, values)
-        logging.info('Finished finding missing threads!')
-        await self.update_blank_start()
-        await self.update_history(guild_threads)
+        self.known_threads.update(thread.id for thread in threads)
+
+    async def update_history(self, threads: dict[int, discord.Thread]):
+        """
+        Backfills every thread whose history isn't complete, wherever it is.
 
-    async def update_history(self, all_threads):
+        Live threads that got messages the indexer never saw are marked incomplete first. A thread stays incomplete until
+        its backfill finishes, so one that fails or is interrupted is picked up again next sync even if the crawl has
+        moved past it.
+        """
         logging.info('Starting history')
-        command = 'SELECT guild_id, thread_id, last_message_id FROM threads;'
+        command = 'SELECT guild_id, thread_id, last_message_id, history_until, history_synced FROM threads ' \
+                  'WHERE NOT history_synced OR thread_id = ANY($1::bigint[]);'
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            rows = await con.fetch(command)
-        for row in tqdm(rows):
-            thread: discord.Thread = next((t for t in all_threads if t.id == row['thread_id']), None)
-            if not thread:
-                continue
-            last_message_id = thread.last_message_id
-            if thread.last_message_id is None:
-                await self._update_thread_history(thread)
-                continue
-            if last_message_id != row['last_message_id']:
-                await self._update_thread_history(thread, row['last_message_id'])
+            rows = await con.fetch(command, list(threads))
+            changed = {
+                row['thread_id'] for row in rows
+                if row['history_synced'] and row['thread_id'] in threads and threads[row['thread_id']].last_message_id != row['last_message_id']
+            }
+            if changed:
+                await con.execute('UPDATE threads SET history_synced = FALSE WHERE thread_id = ANY($1::bigint[]);', list(changed))
+        stale = [row for row in rows if not row['history_synced'] or row['thread_id'] in changed]
+        progress = tqdm(total=len(stale))
+
+        async def backfill(row):
+            async with self.crawl_limit:
+                try:
+                    guild = self.bot.get_guild(row['guild_id'])
+                    thread = threads.get(row['thread_id']) or guild.get_thread(row['thread_id'])
+                    if thread is None:
+                        await self.pacer.wait()
+                        thread = await guild.fetch_channel(row['thread_id'])
+                    await self._update_thread_history(thread, row['history_until'])
+                except discord.NotFound:
+                    # Deleted while nobody was watching, there's nothing left to get
+                    await self._finish_history(row['thread_id'])
+                except discord.HTTPException as e:
+                    logging.warning('Could not get history of {0}, it will resume next sync: {1}'.format(row['thread_id'], e))
+            progress.update()
+
+        await asyncio.gather(*(backfill(row) for row in stale))
+        progress.close()
 
     async def _update_thread_history(self, thread: discord.Thread, last_message_id: Optional[int] = None):
-        command = 'INSERT INTO thread_messages(thread, message_id, message_content, message_content_tsv) VALUES ($1, $2, $3, to_tsvector($3)) ON CONFLICT DO NOTHING;'
+        """
+        Streams the history of a thread after ``last_message_id`` into ``thread_messages``.
+
+        Every chunk is committed along with the id of its last message, so only one chunk is held in memory and a
+        failure resumes from the last committed chunk.
+        """
         values = []
         async for message in thread.history(limit=None, after=discord.Object(last_message_id) if last_message_id else None, oldest_first=True):
             values.append((thread.id, message.id, self.get_content(message)))
+            if len(values) % CRAWL_PAGE == 0:
+                # History is requested a page at a time as it's iterated
+                await self.pacer.wait()
+            if len(values) >= HISTORY_CHUNK:
+                await self._write_history(thread.id, values)
+                values = []
+        if values:
+            await self._write_history(thread.id, values)
+        await self._finish_history(thread.id)
+
+    async def _write_history(self, thread_id, values: list[tuple]):
+        command = 'INSERT INTO thread_messages(thread, message_id, message_content, message_content_tsv) VALUES ($1, $2, $3, to_tsvector($3)) ON CONFLICT DO NOTHING;'
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            await con.executemany(command, values)
-            await con.execute('UPDATE threads SET last_message_id = $1 WHERE thread_id = $2;', thread.last_message_id, thread.id)
+            async with con.transaction():
+                await con.executemany(command, values)
+                await con.execute(
+                    'UPDATE threads SET history_until = $1, last_message_id = GREATEST(last_message_id, $1) WHERE thread_id = $2;',
+                    values[-1][1], thread_id,
+                )
+
+    async def _finish_history(self, thread_id):
+        async with db.MaybeAcquire(pool=self.bot.pool) as con:
+            await con.execute('UPDATE threads SET history_synced = TRUE WHERE thread_id = $1;', thread_id)
 
     @staticmethod
     def get_content(message: discord.Message, owners: Optional[list] = None, thread_id: Optional[int] = None):
@@ -239,7 +558,7 @@ class ThreadCommands(commands.Cog):
             message = message.content
         return message
 
-    async def update_blank_start(self):
+    async def update_blank_start(self, known: Optional[dict[int, discord.Thread]] = None):
         logging.info('Starting updating blank starting messages...')
         command = 'SELECT guild_id, thread_id FROM threads WHERE starting_message IS NULL;'
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
@@ -247,51 +566,73 @@ class ThreadCommands(commands.Cog):
         if len(rows) == 0:
             logging.info('None found!')
             return
-        messages = 'UPDATE threads SET starting_message = $2 WHERE thread_id = $1;'
-        owner_command = 'UPDATE threads SET owner_id = $2 WHERE thread_id = $1;'
-        descriptions = []
-        owners = []
-        for thread in tqdm(rows):
-            thread = dict(thread)
-            guild = self.bot.get_guild(thread['guild_id'])
-            channel: discord.Thread = await guild.fetch_channel(thread['thread_id'])
-            if isinstance(channel.parent, discord.ForumChannel):
-                async for m in channel.history(limit=1, oldest_first=True):
-                    message = m
-                    break
-            else:
-                try:
-                    message = await channel.parent.fetch_message(channel.id)
-                except discord.NotFound:
+        known = known or {}
+        progress = tqdm(total=len(rows))
+
+        async def starting_message(row):
+            async with self.crawl_limit:
+                channel: discord.Thread = known.get(row['thread_id'])
+                if channel is None:
+                    await self.pacer.wait()
+                    channel = await self.bot.get_guild(row['guild_id']).fetch_channel(row['thread_id'])
+                await self.pacer.wait()
+                message = None
+                if not isinstance(channel.parent, discord.ForumChannel):
+                    try:
+                        message = await channel.parent.fetch_message(channel.id)
+                    except discord.NotFound:
+                        pass
+                if message is None:
                     async for m in channel.history(limit=1, oldest_first=True):
                         message = m
                         break
-            descriptions.append((thread['thread_id'], self.get_content(message, owners, thread['thread_id'])))
-        if descriptions:
-            async with db.MaybeAcquire(pool=self.bot.pool) as con:
-                await con.executemany(messages, descriptions)
-        if owners:
+            progress.update()
+            return message
+
+        # Written in chunks so a restart only has to redo the chunk it was on
+        for i in range(0, len(rows), CRAWL_PAGE):
+            chunk = rows[i:i + CRAWL_PAGE]
+            messages = await asyncio.gather(*(starting_message(row) for row in chunk), return_exceptions=True)
+            descriptions = []
+            owners = []
+            for row, message in zip(chunk, messages):
+                if isinstance(message, Exception):
+                    logging.warning('Could not get the starting message of {0}: {1}'.format(row['thread_id'], message))
+                    continue
+                if message is None:
+                    continue
+                descriptions.append((row['thread_id'], self.get_content(message, owners, row['thread_id'])))
             async with db.MaybeAcquire(pool=self.bot.pool) as con:
+                async with con.transaction():
+                    await con.executemany('UPDATE threads SET starting_message = $2 WHERE thread_id = $1;', descriptions)
+                    await con.executemany('UPDATE threads SET owner_id = $2 WHERE thread_id = $1;', owners)
+            if owners:
                 logging.info('Modified {0} owners'.format(len(owners)))
-                await con.executemany(owner_command, owners)
+        progress.close()
         logging.info('Done!')
 
-    @cache.cache(maxsize=1024)
     async def get_thread(self, thread_id) -> ThreadData:
-        command = 'SELECT * FROM threads WHERE thread_id = $1;'
-        async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            row = await con.fetchrow(command, thread_id)
-        if row is None:
-            thread = await self.bot.fetch_channel(thread_id)
-            await self.sync_thread(await ThreadData.from_thread(thread), update_if_exists=False)
-            return await self.get_thread(thread_id)
-        return ThreadData.from_query(self.bot, row)
-
-    async def exists(self, thread_id):
-        command = 'SELECT thread_id FROM threads WHERE thread_id = $1;'
-        async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            row = await con.fetchrow(command, thread_id)
-        return row is not None
+        thread = self.registry.get(thread_id)
+        if thread is not None:
+            return thread
+        # Only a miss takes the lock, so loading races neither on_thread_create nor another miss for the same thread
+        async with self.locks.hold(thread_id):
+            thread = self.registry.get(thread_id)
+            if thread is not None:
+                return thread
+            command = 'SELECT * FROM threads WHERE thread_id = $1;'
+            async with db.MaybeAcquire(pool=self.bot.pool) as con:
+                row = await con.fetchrow(command, thread_id)
+            if row is None:
+                thread = await ThreadData.from_thread(await self.bot.fetch_channel(thread_id))
+                await self.sync_thread(thread, update_if_exists=False)
+                return thread
+            thread = ThreadData.from_query(self.bot, row)
+            self.registry.add(thread)
+            return thread
+
+    def exists(self, thread_id) -> bool:
+        return thread_id in self.known_threads
 
     async def sync_thread(self, thread: ThreadData, update_if_exists=True):
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
@@ -310,14 +651,15 @@ class ThreadCommands(commands.Cog):
             else:
                 command += 'DO NOTHING;'
             await con.execute(command, *thread.args)
-        self.get_thread.set(thread, thread.thread_id)
+        self.known_threads.add(thread.thread_id)
+        self.registry.add(thread)
 
     @commands.Cog.listener()
     async def on_thread_create(self, thread: discord.Thread):
         if thread.guild.id != 753693459369427044:
             return
-        async with self.lock:
-            if self.get_thread.exists(thread.id):
+        async with self.locks.hold(thread.id):
+            if self.exists(thread.id):
                 return
             await self.sync_thread(await ThreadData.from_thread(thread), update_if_exists=False)
         if thread.owner is not None:
@@ -344,16 +686,17 @@ class ThreadCommands(commands.Cog):
             return
         if message.guild is None or message.guild.id != 753693459369427044:
             return
-        await asyncio.sleep(0.3)
-        command = 'INSERT INTO thread_messages(thread, message_id, message_content, message_content_tsv) VALUES ($1, $2, $3, to_tsvector($3)) ON CONFLICT DO NOTHING;'
-        async with self.lock:
-            thread: ThreadData = await self.get_thread(message.channel.id)
-            if thread is None:
-                logging.error("Thread with name {0} does not exist!!!".format(message.channel.name))
-                return
-            async with db.MaybeAcquire(pool=self.bot.pool) as con:
-                await con.execute(command, message.channel.id, message.id, self.get_content(message))
-                await thread.update_last_message_id(message.id, pool=self.bot.pool)
+        if message.id == message.channel.id and message.channel.id not in self.registry:
+            # The starting message of a forum post, let on_thread_create store the thread and welcome its owner first
+            await asyncio.sleep(0.3)
+        # Makes sure the thread is stored before any of its messages are
+        thread: ThreadData = await self.get_thread(message.channel.id)
+        if thread is None:
+            logging.error("Thread with name {0} does not exist!!!".format(message.channel.name))
+            return
+        # The stored id is updated when the indexer flushes
+        thread.last_message_id = message.id
+        await self.indexer.put((message.channel.id, message.id, self.get_content(message)))
 
     @commands.Cog.listener()
     async def on_raw_thread_update(self, payload: discord.RawThreadUpdateEvent):
@@ -367,7 +710,7 @@ class ThreadCommands(commands.Cog):
             if thread.archived:
                 await thread.edit(archived=False, reason="Disabled archive")
         if thread.name != thread_data.title:
-            await thread_data.update_title(thread.name, pool=self.bot.pool)
+            await thread_data.update_title(thread.name)
 
     @commands.Cog.listener()
     async def on_raw_thread_delete(self, payload: discord.RawThreadDeleteEvent):
@@ -376,6 +719,8 @@ class ThreadCommands(commands.Cog):
         command = 'DELETE FROM threads WHERE thread_id = $1;'
         async with db.MaybeAcquire(pool=self.bot.pool) as con:
             await con.execute(command, payload.thread_id)
+        self.known_threads.discard(payload.thread_id)
+        self.registry.remove(payload.thread_id)
 
     async def check(self, ctx: Context) -> bool:
 
@@ -41,7 +41,7 @@ class ThreadDiscovery(commands.Cog):
             return
         if message.guild is None or message.guild.id != 753693459369427044:
             return
-        if not await self.bot.thread_handler.exists(message.channel.id):
+        if not self.bot.thread_handler.exists(message.channel.id):
             return
         thread: discord.Thread = message.channel
         if not self.bot.thread_handler.is_channel_public(thread.parent):
@@ -15,8 +15,7 @@ from bot.cogs.thread import ThreadData
 from bot.core.context import Context
 from bot.util.webhooker import Webhooker
 
-from contextlib import asynccontextmanager
-from bot.util import cache
+from bot.util import cache, locks
 
 if TYPE_CHECKING:
     from bot.mikro import Mikro
@@ -190,7 +189,7 @@ class Github(commands.Cog):
 
     def __init__(self, bot):
         self.bot: Mikro = bot
-        self.locks = {}
+        self.locks = locks.KeyedLock()
 
     def data_to_kwargs(self, data):
         return {
@@ -199,15 +198,8 @@ class Github(commands.Cog):
             'avatar_url': data['user']['avatar_url']
         }
 
-    @asynccontextmanager
-    async def get_lock(self, installation_id):
-        # https://stackoverflow.com/questions/66994203/create-asyncio-lock-with-name
-        if installation_id not in self.locks:
-            self.locks[installation_id] = asyncio.Lock()
-        async with self.locks[installation_id]:
-            yield
-        if self.locks[installation_id]._waiters is None or len(self.locks[installation_id]._waiters) == 0:
-            del self.locks[installation_id]
+    def get_lock(self, installation_id):
+        return self.locks.hold(installation_id)
 
     def message_to_content(self, message: discord.Message):
         return f'`Comment from: {message.author}`\n{message.content}'
@@ -29,6 +29,7 @@ startup_extensions = (
     'bot.response.response_cog',
     'bot.plant.tree_cog',
     'bot.cogs.stats',
+    'bot.cogs.analytics',
     'bot.cogs.search',
     'bot.cogs.embed_helper',
     'bot.cogs.thread_discovery',
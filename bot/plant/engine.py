@@ -0,0 +1,80 @@
+"""
+Vectorized evaluation of tree state.
+
+Every tree decays the same way, so instead of evaluating the properties of each :class:`TreeObject` one at a time the
+stored state of many trees is put into NumPy arrays and evaluated at one snapshot time in a single pass.
+"""
+from datetime import datetime
+from typing import Iterable, Optional
+
+import numpy as np
+
+from bot.util import activity, time_util
+
+# Seconds that a height is considered fresh and isn't recalculated
+HEIGHT_GRACE = 5
+
+
+def decay(value: np.ndarray, minutes: np.ndarray, slow_factor: np.ndarray) -> np.ndarray:
+    """Water and care, ``TreeObject.default_water`` for arrays (including the clamp and ceil)"""
+    decayed = value - (180 / (1 + np.exp(-minutes / 40)) - 90) / slow_factor
+    decayed = np.where(value < 10, value, decayed)
+    return np.ceil(np.clip(decayed, 0, 1000))
+
+
+def growth(water: np.ndarray, care: np.ndarray) -> np.ndarray:
+    """Height gained (or lost) per hour for a given water and care"""
+    val = water + care - 1000
+    val = np.where(val < 0, np.ceil(val / 2), val)
+    # Get it between -1 and 1
+    val = val / 1000 * 2
+    return np.where(val < 0, (.5 / (1 + np.exp(-5 * val)) - .25) / 5, val)
+
+
+# Most height any tree can gain in an hour (full water and care)
+MAX_GROWTH = float(growth(np.float64(1000), np.float64(1000)))
+
+
+def grow(height: np.ndarray, seconds: np.ndarray, water: np.ndarray, care: np.ndarray) -> np.ndarray:
+    grown = np.maximum(0.0, height + growth(water, care) * (seconds / 3600))
+    return np.where(seconds < HEIGHT_GRACE, height, grown)
+
+
+def evaluate(height, water, care, last_height, last_water, last_care, slow_factor, now) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Closed form ``(height, water, care)`` of stored tree state at ``now`` (epoch seconds).
+
+    Everything broadcasts, so this works for many trees at one time, one tree at many times, or both.
+    """
+    water = decay(water, (now - last_water) / 60, slow_factor)
+    care = decay(care, (now - last_care) / 60, slow_factor)
+    height = grow(height, now - last_height, water, care)
+    return height, water, care
+
+
+class TreeEngine:
+    """
+    Stored state of many trees as parallel arrays.
+    """
+
+    def __init__(self, trees: Iterable):
+        trees = list(trees)
+        self.trees = trees
+        size = len(trees)
+        self.height = np.fromiter((t._height for t in trees), dtype=np.float64, count=size)
+        self.water = np.fromiter((t._water for t in trees), dtype=np.float64, count=size)
+        self.care = np.fromiter((t._care for t in trees), dtype=np.float64, count=size)
+        self.last_height = np.fromiter((activity.to_epoch(t.last_height) for t in trees), dtype=np.float64, count=size)
+        self.last_water = np.fromiter((activity.to_epoch(t.last_water) for t in trees), dtype=np.float64, count=size)
+        self.last_care = np.fromiter((activity.to_epoch(t.last_care) for t in trees), dtype=np.float64, count=size)
+        self.slow_factor = np.fromiter((t.get_slow_factor() for t in trees), dtype=np.float64, count=size)
+
+    def __len__(self):
+        return len(self.trees)
+
+    def evaluate(self, now: Optional[datetime] = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns ``(height, water, care)`` arrays for every tree at ``now``"""
+        now = activity.to_epoch(now or time_util.get_utc())
+        return evaluate(
+            self.height, self.water, self.care, self.last_height, self.last_water, self.last_care, self.slow_factor, now,
+        )
@@ -0,0 +1,72 @@
+"""
+Tree state at arbitrary points in time.
+
+The stored state of a tree (height, water and care with the time each was last set) fully describes it until the next
+time it's watered or cared for. Snapshots of that state are saved to ``tree_history`` whenever trees are flushed, so the
+state at any time is the closed form evaluation of the latest snapshot before it.
+"""
+from datetime import datetime
+
+import numpy as np
+
+from bot.plant import engine
+from bot.util import activity
+
+
+class TreeHistory:
+    """
+    Snapshots of one tree's stored state, ordered by time, as arrays.
+    """
+
+    def __init__(self, rows, *, slow_factor):
+        size = len(rows)
+        self.slow_factor = slow_factor
+        self.time = np.fromiter((activity.to_epoch(r['time']) for r in rows), dtype=np.float64, count=size)
+        self.height = np.fromiter((r['height'] for r in rows), dtype=np.float64, count=size)
+        self.water = np.fromiter((r['water'] for r in rows), dtype=np.float64, count=size)
+        self.care = np.fromiter((r['care'] for r in rows), dtype=np.float64, count=size)
+        self.last_height = np.fromiter((activity.to_epoch(r['last_height']) for r in rows), dtype=np.float64, count=size)
+        self.last_water = np.fromiter((activity.to_epoch(r['last_water']) for r in rows), dtype=np.float64, count=size)
+        self.last_care = np.fromiter((activity.to_epoch(r['last_care']) for r in rows), dtype=np.float64, count=size)
+
+    def __len__(self):
+        return len(self.time)
+
+    def at(self, times: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        ``(height, water, care)`` at every time (epoch seconds). Times before the first snapshot are NaN.
+        """
+        times = np.asarray(times, dtype=np.float64)
+        if len(self) == 0:
+            nan = np.full(times.shape, np.nan)
+            return nan, nan.copy(), nan.copy()
+        # Latest snapshot at or before each time
+        index = np.searchsorted(self.time, times, side='right') - 1
+        known = index >= 0
+        index = np.clip(index, 0, len(self) - 1)
+        height, water, care = engine.evaluate(
+            self.height[index], self.water[index], self.care[index],
+            self.last_height[index], self.last_water[index], self.last_care[index],
+            self.slow_factor, times,
+        )
+        return np.where(known, height, np.nan), np.where(known, water, np.nan), np.where(known, care, np.nan)
+
+
+def sample_times(start: datetime, end: datetime, points: int) -> np.ndarray:
+    return np.linspace(activity.to_epoch(start), activity.to_epoch(end), points)
+
+
+def chart(values: np.ndarray, *, rows=8) -> str:
+    """Column chart of values, one column per value. NaN columns are left empty."""
+    blocks = ' ▁▂▃▄▅▆▇█'
+    finite = values[np.isfinite(values)]
+    top = finite.max() if finite.size else 0
+    if top <= 0:
+        top = 1
+    # Eighths of a row filled in each column
+    filled = np.where(np.isfinite(values), np.round(values / top * rows * 8), 0).astype(np.int64)
+    lines = []
+    for row in range(rows - 1, -1, -1):
+        level = np.clip(filled - row * 8, 0, 8)
+        lines.append(''.join(np.array(list(blocks))[level]))
+    return '\n'.join(lines)
@@ -1,19 +1,26 @@
+import asyncio
+import logging
 import math
-from datetime import datetime
-from typing import Union
+import time
+from datetime import datetime, timedelta
+from typing import Literal, NamedTuple, Optional, Union
 
 import discord
+import numpy as np
 
 from bot.cogs import stats
 from bot.core.context import Context
 from bot.core.embed import Embed
-from bot.util import time_util, cache
+import bot as bot_global
+from bot.util import time_util, cache, wal, bulk
 
 from discord.ext import commands
+from lru import LRU
 from bot.util import database as db
 from enum import Enum
 import random
 
+from bot.plant import engine, simulation
 from bot.util.tree import Bonsai
 
 
@@ -34,6 +41,8 @@ class TreeStorage(db.Table, table_name='tree_storage'):
     last_care = db.Column(db.Datetime())
     water = db.Column(db.Integer())
     care = db.Column(db.Integer())
+    # Height evaluated when the row was last written or ranks were last refreshed. Only used to rank trees.
+    rank_height = db.Column(db.Float())
 
     @classmethod
     def create_table(cls, *, overwrite=False):
@@ -41,13 +50,88 @@ class TreeStorage(db.Table, table_name='tree_storage'):
 
         # create constraints
         sql = 'ALTER TABLE tree_storage DROP CONSTRAINT IF EXISTS unique_tree;' \
-              'ALTER TABLE tree_storage ADD CONSTRAINT unique_tree UNIQUE (guild_id, object_id);'
+              'ALTER TABLE tree_storage ADD CONSTRAINT unique_tree UNIQUE (guild_id, object_id);' \
+              'ALTER TABLE tree_storage ADD COLUMN IF NOT EXISTS rank_height float;' \
+              'UPDATE tree_storage SET rank_height = height WHERE rank_height IS NULL;' \
+              'CREATE INDEX IF NOT EXISTS tree_storage_rank_idx ON tree_storage (guild_id, type, rank_height DESC);'
 
         return statement + '\n' + sql
 
 
+# How long tree_history snapshots are kept
+HISTORY_DAYS = 30
+TREE_COLUMNS = ('guild_id', 'object_id', 'type', 'height', 'last_height', 'last_water', 'last_care', 'water', 'care')
+STORAGE_COLUMNS = TREE_COLUMNS + ('rank_height',)
+TREE_CONFLICT = 'ON CONFLICT ON CONSTRAINT unique_tree DO UPDATE SET ' + ', '.join(
+    '{0} = EXCLUDED.{0}'.format(column) for column in STORAGE_COLUMNS[2:]
+)
+# How many trees are shown in the leaderboard, and how long one is cached for
+TOP_SIZE = 10
+TOP_SECONDS = 60
+# How often rank_height of every stored tree is brought up to date
+RANK_MINUTES = 15
+
+
+class FlushMetrics:
+
+    def __init__(self):
+        self.flushes = 0
+        self.rows = 0
+        self.total_time = 0.0
+        self.last_rows = 0
+        self.last_time = 0.0
+
+    def add(self, rows, elapsed):
+        self.flushes += 1
+        self.rows += rows
+        self.total_time += elapsed
+        self.last_rows = rows
+        self.last_time = elapsed
+
+    def __str__(self):
+        if self.flushes == 0:
+            return 'No flushes yet'
+        return 'Last flush {0} trees in {1:.1f}ms, {2} flushes averaging {3:.1f}ms'.format(
+            self.last_rows, self.last_time * 1000, self.flushes, self.total_time / self.flushes * 1000,
+        )
+
+
+class TreeState(NamedTuple):
+    height: float
+    water: int
+    care: int
+
+
+class TreeHistory(db.Table, table_name='tree_history'):
+    guild_id = db.Column(db.Integer(big=True))
+    object_id = db.Column(db.Integer(big=True))
+    time = db.Column(db.Datetime())
+    height = db.Column(db.Float())
+    last_height = db.Column(db.Datetime())
+    last_water = db.Column(db.Datetime())
+    last_care = db.Column(db.Datetime())
+    water = db.Column(db.Integer())
+    care = db.Column(db.Integer())
+
+    @classmethod
+    def create_table(cls, *, overwrite=False):
+        statement = super().create_table(overwrite=overwrite)
+
+        sql = 'CREATE INDEX IF NOT EXISTS tree_history_tree_idx ON tree_history (guild_id, object_id, time);'
+
+        return statement + '\n' + sql
+
+
+HISTORY_COLUMNS = ('guild_id', 'object_id', 'time', 'height', 'last_height', 'last_water', 'last_care', 'water', 'care')
+
+
 class TreeObject:
 
+    __slots__ = (
+        'guild_id', 'object_id', 'type', '_height', 'last_height', 'last_water', 'last_care', '_water', '_care',
+        'water_equation', 'care_equation',
+    )
+
     def __init__(self, guild_id, object_id, type, height, last_height, last_water, last_care, water, care, *, water_equation=None, care_equation=None):
         self.guild_id: int = guild_id
         self.object_id: int = object_id
@@ -65,38 +149,53 @@ class TreeObject:
         if self.care_equation is None:
             self.care_equation = TreeObject.default_care
 
+    def state(self, now: Optional[datetime] = None) -> TreeState:
+        """Height, water and care all evaluated at the same time"""
+        now = now or time_util.get_utc()
+        water = self.water_at(now)
+        care = self.care_at(now)
+        return TreeState(self.height_at(now, water=water, care=care), water, care)
+
     @property
     def height(self):
-        if (time_util.get_utc() - self.last_height).total_seconds() < 5:
+        return self.height_at(time_util.get_utc())
+
+    def height_at(self, now: datetime, *, water=None, care=None) -> float:
+        seconds = (now - self.last_height).total_seconds()
+        if seconds < engine.HEIGHT_GRACE:
             return self._height
-        val = self.water + self.care - 1000
+        if water is None:
+            water = self.water_at(now)
+        if care is None:
+            care = self.care_at(now)
+        val = water + care - 1000
         if val < 0:
             val = math.ceil(val / 2)
         # Get it between -1 and 1
         val = val / 1000 * 2
         if val < 0:
             val = (.5 / (1 + math.exp(-5 * val)) - .25) / 5
-        h = self._height + val * (((time_util.get_utc() - self.last_height).total_seconds() / 60) / 60)
+        h = self._height + val * ((seconds / 60) / 60)
         return max(0.0, h)
 
-    def update_height(self, val):
+    def update_height(self, val, *, now: Optional[datetime] = None):
         val = max(val, 0)
         self._height = val
-        self.last_height = time_util.get_utc()
+        self.last_height = now or time_util.get_utc()
 
     @staticmethod
-    def default_water(x: int, updated: datetime, slow_factor):
+    def default_water(x: int, updated: datetime, slow_factor, now: Optional[datetime] = None):
         if x < 10:
             return x
-        val = (time_util.get_utc() - updated).total_seconds() / 60
+        val = ((now or time_util.get_utc()) - updated).total_seconds() / 60
         return x - (180 / (1 + math.exp(- val / 40)) - 90) / slow_factor
 
     @staticmethod
-    def default_care(x: int, updated: datetime, slow_factor):
+    def default_care(x: int, updated: datetime, slow_factor, now: Optional[datetime] = None):
         if x < 10:
             return x
         # We want 1.01 ^ (minutes since)
-        val = (time_util.get_utc() - updated).total_seconds() / 60
+        val = ((now or time_util.get_utc()) - updated).total_seconds() / 60
         return x - (180 / (1 + math.exp(- val / 40)) - 90) / slow_factor
 
     def get_slow_factor(self):
@@ -109,15 +208,21 @@ class TreeObject:
 
     @property
     def water(self) -> int:
+        return self.water_at(time_util.get_utc())
+
+    def water_at(self, now: datetime) -> int:
         return math.ceil(
             max(0, min(
-                self.water_equation(self._water, self.last_water, self.get_slow_factor()), 1000
+                self.water_equation(self._water, self.last_water, self.get_slow_factor(), now), 1000
             ))
         )
 
     @property
     def care(self):
-        val = self.care_equation(self._care, self.last_care, self.get_slow_factor())
+        return self.care_at(time_util.get_utc())
+
+    def care_at(self, now: datetime) -> int:
+        val = self.care_equation(self._care, self.last_care, self.get_slow_factor(), now)
         return math.ceil(
             max(0, min(
                 val, 1000
@@ -125,18 +230,20 @@ class TreeObject:
         )
 
     def update_care(self, value):
+        now = time_util.get_utc()
         value = min(1000, max(0, value))
-        self.last_care = time_util.get_utc()
+        self.last_care = now
         self._care = value
-        self.update_height(self.height)
+        self.update_height(self.height_at(now), now=now)
 
     def update_water(self, value):
+        now = time_util.get_utc()
         value = min(1000, max(0, value))
-        self.last_water = time_util.get_utc()
+        self.last_water = now
         self._water = value
-        self.update_height(self.height)
+        self.update_height(self.height_at(now), now=now)
 
-    async def add_water(self, stats_obj: stats.Stats, message: stats.Message):
+    def add_water(self, message: stats.Message):
         if message.type == stats.MessageType.long:
             val = random.randint(50, 80)
         elif message.type == stats.MessageType.attachment:
@@ -152,8 +259,8 @@ class TreeObject:
                 val = val // 3
         self.update_water(self.water + val)
 
-    async def add_care(self, stats_obj: stats.Stats, message: stats.Message):
-        author: dict[stats.CooldownInterval, int] = await stats_obj.get_messages_in_cooldowns(message.guild_id, user_id=message.author_id)
+    def add_care(self, author: dict[stats.CooldownInterval, int], message: stats.Message):
+        """``author`` is the author's activity in the guild from before this message"""
         if author.get(stats.CooldownInterval.hours_24, 0) == 0:
             val = random.randint(30, 50)
         elif author.get(stats.CooldownInterval.hours_1, 0) <= 2:
@@ -169,6 +276,13 @@ class TreeObject:
                 val = val // 3
         self.update_care(self.care + val)
 
+    def to_record(self) -> tuple:
+        """Stored state, without evaluating decay. Can be passed back into the constructor."""
+        return (
+            self.guild_id, self.object_id, self.type.value, self._height, self.last_height, self.last_water,
+            self.last_care, self._water, self._care,
+        )
+
     def __eq__(self, other):
         if not isinstance(other, TreeObject):
             return False
@@ -178,10 +292,11 @@ class TreeObject:
         return hash(self.object_id)
 
     def __str__(self):
+        state = self.state()
         care_time: str = self.last_care.strftime("'%Y-%m-%d %H:%M:%S'")
         water_time: str = self.last_water.strftime("'%Y-%m-%d %H:%M:%S'")
         height_time: str = self.last_height.strftime("'%Y-%m-%d %H:%M:%S'")
-        return '({0}, {1}, {2}, {3}, {4}, {5}, {6}, {7}, {8})'.format(self.guild_id, self.object_id, self.type.value, self.height, height_time, water_time, care_time, self.water, self.care)
+        return '({0}, {1}, {2}, {3}, {4}, {5}, {6}, {7}, {8})'.format(self.guild_id, self.object_id, self.type.value, state.height, height_time, water_time, care_time, state.water, state.care)
 
 
 class Tree(commands.Cog):
@@ -189,7 +304,47 @@ class Tree(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.bot.add_loop('update_trees', self.update_trees)
-        self.updated_trees: set[TreeObject] = set()
+        # Every tree that has been looked up recently, keyed by (guild_id, object_id)
+        self.trees: LRU = LRU(bot_global.config.get('tree_cache_size', 4096))
+        # Trees that changed since the last push. These stay here even if they're evicted from the LRU.
+        self.dirty: dict[tuple[int, int], TreeObject] = {}
+        # Trees that are being written by push_trees. They stay visible until it commits since the LRU may have dropped them.
+        self.flushing: dict[tuple[int, int], TreeObject] = {}
+        self._loading: dict[tuple[int, int], asyncio.Future] = {}
+        self.flush_chunk_size: int = bot_global.config.get('tree_flush_chunk_size', 1000)
+        self.flush_metrics = FlushMetrics()
+        self.wal = wal.WriteAheadLog(bot_global.config.get('wal_directory', 'config/wal'), 'trees')
+        self.top_cache = cache.ExpiringDict(seconds=TOP_SECONDS)
+        # Every rank_height was evaluated at this time or later
+        self.ranked_at: Optional[datetime] = None
+
+    async def cog_load(self) -> None:
+        # Latest state for each tree wins
+        replayed = {}
+        for _, record in self.wal.open():
+            tree = TreeObject(*record)
+            replayed[(tree.guild_id, tree.object_id)] = tree
+        if replayed:
+            logging.info('Replaying {0} trees from the write-ahead log'.format(len(replayed)))
+            self.dirty.update(replayed)
+            await self.push_trees()
+        await self.refresh_ranks()
+        await self.preload()
+
+    async def preload(self):
+        """Loads every guild and channel tree in one query since those get touched by almost every message."""
+        command = 'SELECT guild_id, object_id, type, height, last_height, last_water, last_care, water, care FROM tree_storage WHERE type = ANY($1::smallint[]);'
+        async with db.MaybeAcquire(pool=self.bot.pool) as con:
+            rows = await con.fetch(command, [TreeType.guild.value, TreeType.channel.value])
+        for row in rows:
+            key = (row['guild_id'], row['object_id'])
+            if key in self.dirty:
+                continue
+            self.trees[key] = TreeObject(*row.values())
+
+    async def cog_unload(self) -> None:
+        await self.push_trees()
+        self.wal.close()
 
     @property
     def stats_obj(self) -> stats.Stats:
@@ -207,10 +362,11 @@ class Tree(commands.Cog):
                 embed.title = '#' + ctx.guild.get_channel(tree.object_id).name
 
         embed.title = 'Tree for ' + embed.title
-        embed.add_field(name='Water', value='{0}%'.format(tree.water // 10))
-        embed.add_field(name='Care', value='{0}%'.format(tree.care // 10))
-        embed.add_field(name='Height', value='{0:.2f}'.format(tree.height))
-        h = tree.height
+        state = tree.state()
+        embed.add_field(name='Water', value='{0}%'.format(state.water // 10))
+        embed.add_field(name='Care', value='{0}%'.format(state.care // 10))
+        embed.add_field(name='Height', value='{0:.2f}'.format(state.height))
+        h = state.height
         if h < 8:
             h = 6
         elif h < 15:
@@ -219,8 +375,8 @@ class Tree(commands.Cog):
             h = 25
         else:
             h = 32
-        b = Bonsai(height=h, width=32)
-        embed.description = '''```\n{0}```'''.format(b.run(life=min(math.ceil(tree.height) + 1, 50)).get_string())
+        tree_string = Bonsai.render(tree.object_id, min(math.ceil(state.height) + 1, 50), width=32, height=h)
+        embed.description = '''```\n{0}```'''.format(tree_string)
         return embed
 
     @commands.command(name='guildtree')
@@ -230,7 +386,7 @@ class Tree(commands.Cog):
         embed = self.gen_tree(ctx, tree)
         await ctx.send(embed=embed)
 
-    @commands.command(name='tree')
+    @commands.group(name='tree', invoke_without_command=True)
     @commands.guild_only()
     async def tree_stats(self, ctx: Context, *, tree: Union[None, discord.Member, discord.TextChannel] = None):
         if tree is None:
@@ -242,80 +398,253 @@ class Tree(commands.Cog):
         embed = self.gen_tree(ctx, tree)
         await ctx.send(embed=embed)
 
+    @tree_stats.command(name='history')
+    @commands.guild_only()
+    async def tree_history(self, ctx: Context, tree: Union[None, discord.Member, discord.TextChannel] = None, days: int = 7):
+        if tree is None:
+            tree = ctx.author
+        days = min(max(days, 1), HISTORY_DAYS)
+        name = tree.display_name if isinstance(tree, discord.Member) else '#' + tree.name
+        tree = await self.get_tree(ctx.guild.id, tree.id, TreeType.user if isinstance(tree, discord.Member) else TreeType.channel)
+        now = time_util.get_utc()
+        start = now - timedelta(days=days)
+        command = 'SELECT * FROM (' \
+                  '(SELECT time, height, last_height, last_water, last_care, water, care FROM tree_history ' \
+                  'WHERE guild_id = $1 AND object_id = $2 AND time < $3 ORDER BY time DESC LIMIT 1) ' \
+                  'UNION ALL ' \
+                  '(SELECT time, height, last_height, last_water, last_care, water, care FROM tree_history ' \
+                  'WHERE guild_id = $1 AND object_id = $2 AND time >= $3)' \
+                  ') snapshots ORDER BY time;'
+        async with db.MaybeAcquire(pool=self.bot.pool) as con:
+            rows = [dict(r) for r in await con.fetch(command, ctx.guild.id, tree.object_id, start)]
+        # What's in memory might be newer than the last flush
+        rows.append(dict(zip(TREE_COLUMNS, tree.to_record()), time=now))
+        history = simulation.TreeHistory(rows, slow_factor=tree.get_slow_factor())
+        heights, _, _ = history.at(simulation.sample_times(start, now, 48))
+        top = np.nanmax(heights) if np.isfinite(heights).any() else 0
+        embed = Embed(title='Growth of {0}'.format(name))
+        embed.set_description('```\n{0:.2f}\n{1}\n{2:<24}{3:>24}```'.format(
+            top, simulation.chart(heights), start.strftime('%b %d'), 'Now',
+        ))
+        await ctx.send(embed=embed)
+
+    @tree_stats.command(name='top')
+    @commands.guild_only()
+    async def tree_top(self, ctx: Context, kind: Literal['user', 'channel'] = 'user'):
+        tree_type = TreeType[kind]
+        trees = await self.get_top(ctx.guild.id, tree_type)
+        if not trees:
+            await ctx.send('No trees have grown yet!')
+            return
+        lines = []
+        for i, (tree, height) in enumerate(trees):
+            if tree_type == TreeType.user:
+                member = ctx.guild.get_member(tree.object_id)
+                name = member.display_name if member else str(tree.object_id)
+            else:
+                channel = ctx.guild.get_channel(tree.object_id)
+                name = '#' + channel.name if channel else str(tree.object_id)
+            lines.append('`{0:>2}.` **{1}** {2:.2f}'.format(i + 1, discord.utils.escape_markdown(name), height))
+        embed = Embed(title='Tallest {0} trees'.format(kind))
+        embed.set_description('\n'.join(lines))
+        await ctx.send(embed=embed)
+
+    async def get_top(self, guild_id, type: TreeType, *, limit=TOP_SIZE) -> list[tuple[TreeObject, float]]:
+        """
+        Tallest trees of a type in a guild with their current height.
+
+        Postgres ranks stored trees by ``rank_height`` through an index. No tree can have grown more than
+        :data:`engine.MAX_GROWTH` an hour since its ``rank_height`` was evaluated (at the latest :attr:`ranked_at`), so
+        once the top ``limit`` are re-ranked at the current time every tree that could still beat the last of them is
+        fetched and ranked too, along with anything that hasn't been written yet.
+        """
+        key = (guild_id, type, limit)
+        if key in self.top_cache:
+            return self.top_cache[key]
+        now = time_util.get_utc()
+        columns = 'guild_id, object_id, type, height, last_height, last_water, last_care, water, care, rank_height'
+        command = 'SELECT {0} FROM tree_storage WHERE guild_id = $1 AND type = $2 ORDER BY rank_height DESC LIMIT $3;'.format(columns)
+        async with db.MaybeAcquire(pool=self.bot.pool) as con:
+            rows = await con.fetch(command, guild_id, type.value, limit)
+            top = self._rank(rows, guild_id, type, now)[:limit]
+            if len(rows) == limit and len(top) == limit:
+                hours = (now - self.ranked_at).total_seconds() / 3600 if self.ranked_at is not None else math.inf
+                lowest = top[-1][1] - engine.MAX_GROWTH * hours
+                if rows[-1]['rank_height'] >= lowest:
+                    command = 'SELECT {0} FROM tree_storage WHERE guild_id = $1 AND type = $2 AND rank_height >= $3;'.format(columns)
+                    rows = await con.fetch(command, guild_id, type.value, lowest)
+                    top = self._rank(rows, guild_id, type, now)[:limit]
+        self.top_cache[key] = top
+        return top
+
+    def _rank(self, rows, guild_id, type: TreeType, now: datetime) -> list[tuple[TreeObject, float]]:
+        """Stored rows and unwritten trees of a type in a guild, tallest first at ``now``"""
+        candidates = {(row['guild_id'], row['object_id']): TreeObject(*list(row.values())[:9]) for row in rows}
+        for tree_key, tree in (*self.flushing.items(), *self.dirty.items()):
+            if tree.guild_id == guild_id and tree.type == type:
+                candidates[tree_key] = tree
+        trees = list(candidates.values())
+        if not trees:
+            return []
+        heights, _, _ = engine.TreeEngine(trees).evaluate(now)
+        return [(trees[i], float(heights[i])) for i in np.argsort(-heights, kind='stable')]
+
+    async def refresh_ranks(self):
+        """
+        Re-evaluates ``rank_height`` of every stored tree, a chunk at a time in key order. Rows that were written since
+        they were read already have a newer rank and are left alone.
+        """
+        now = time_util.get_utc()
+        read = 'SELECT guild_id, object_id, type, height, last_height, last_water, last_care, water, care FROM tree_storage ' \
+               'WHERE (guild_id, object_id) > ($1, $2) ORDER BY guild_id, object_id LIMIT $3;'
+        write = 'UPDATE tree_storage t SET rank_height = u.rank_height ' \
+                'FROM unnest($1::bigint[], $2::bigint[], $3::float[], $4::timestamp[], $5::timestamp[], $6::timestamp[], $7::float[]) ' \
+                'AS u(guild_id, object_id, height, last_height, last_water, last_care, rank_height) ' \
+                'WHERE t.guild_id = u.guild_id AND t.object_id = u.object_id AND t.height = u.height ' \
+                'AND t.last_height = u.last_height AND t.last_water = u.last_water AND t.last_care = u.last_care;'
+        last = (-1, -1)
+        while True:
+            async with db.MaybeAcquire(pool=self.bot.pool) as con:
+                rows = await con.fetch(read, *last, self.flush_chunk_size)
+                if not rows:
+                    break
+                trees = [TreeObject(*row.values()) for row in rows]
+                heights, _, _ = engine.TreeEngine(trees).evaluate(now)
+                await con.execute(
+                    write,
+                    [t.guild_id for t in trees], [t.object_id for t in trees], [t._height for t in trees],
+                    [t.last_height for t in trees], [t.last_water for t in trees], [t.last_care for t in trees],
+                    [float(h) for h in heights],
+                )
+            last = (rows[-1]['guild_id'], rows[-1]['object_id'])
+        if self.ranked_at is None or now > self.ranked_at:
+            self.ranked_at = now
+
     @commands.is_owner()
     @commands.command(name='pushtree')
     async def push_tree(self, ctx):
         await self.update_trees(None)
+        await ctx.send(str(self.flush_metrics), ephemeral=True)
 
     async def update_trees(self, time):
-        if len(self.updated_trees) == 0:
+        if time is not None and time.minute % RANK_MINUTES == 0:
+            await self.refresh_ranks()
+        if len(self.dirty) == 0:
             return
         if time is not None and time.minute % 5 != 0:
             return
-        values = [str(tree) for tree in self.updated_trees]
-        command = "INSERT INTO tree_storage(guild_id, object_id, type, height, last_height, last_water, last_care, water, care)" \
-                  " VALUES {0} " \
-                  "ON CONFLICT ON CONSTRAINT unique_tree DO UPDATE SET " \
-                  "guild_id = EXCLUDED.guild_id, " \
-                  "object_id = EXCLUDED.object_id, " \
-                  "type = EXCLUDED.type, " \
-                  "height = EXCLUDED.height, " \
-                  "last_height = EXCLUDED.last_height, " \
-                  "last_water = EXCLUDED.last_water, " \
-                  "last_care = EXCLUDED.last_care, " \
-                  "water = EXCLUDED.water, " \
-                  "care = EXCLUDED.care;".format(', '.join(values))
-        async with db.MaybeAcquire(pool=self.bot.pool) as con:
-            await con.execute(command)
-        self.updated_trees.clear()
+        await self.push_trees()
         await self.set_status()
+        if time is not None and time.hour == 0 and time.minute == 0:
+            async with db.MaybeAcquire(pool=self.bot.pool) as con:
+                await con.execute('DELETE FROM tree_history WHERE time < $1;', time_util.get_utc() - timedelta(days=HISTORY_DAYS))
+
+    async def push_trees(self):
+        if len(self.dirty) == 0:
+            return
+        seq = self.wal.seq
+        # Anything that changes while this is being written goes into the next push
+        trees, self.dirty = self.dirty, {}
+        self.flushing.update(trees)
+        # Stored state is written as is, decay is evaluated from the timestamps whenever it's read
+        now = time_util.get_utc()
+        heights, _, _ = engine.TreeEngine(trees.values()).evaluate(now)
+        records = [tree.to_record() + (float(height),) for tree, height in zip(trees.values(), heights)]
+        start = time.perf_counter()
+        try:
+            async with db.MaybeAcquire(pool=self.bot.pool) as con:
+                for i in range(0, len(records), self.flush_chunk_size):
+                    chunk = records[i:i + self.flush_chunk_size]
+                    async with con.transaction():
+                        await bulk.copy_upsert(con, 'tree_storage', STORAGE_COLUMNS, chunk, conflict=TREE_CONFLICT)
+                        await con.copy_records_to_table(
+                            'tree_history', records=[(r[0], r[1], now, *r[3:-1]) for r in chunk], columns=HISTORY_COLUMNS,
+                        )
+        except BaseException:
+            for key, tree in trees.items():
+                self.dirty.setdefault(key, tree)
+            raise
+        finally:
+            for key, tree in trees.items():
+                # A push that started after this one may be writing a newer copy
+                if self.flushing.get(key) is tree:
+                    del self.flushing[key]
+        self.flush_metrics.add(len(records), time.perf_counter() - start)
+        self.wal.release(seq)
 
     async def on_message(self, message: stats.Message):
         # This is called from stats
-        await self.guild_tree(message)
-        await self.user_tree(message)
-        await self.channel_tree(message)
+        # All three trees base care off of the same activity, so only look it up once
+        author = self.stats_obj.get_activity(message.guild_id, user_id=message.author_id)
+        await self.guild_tree(message, author)
+        await self.user_tree(message, author)
+        await self.channel_tree(message, author)
 
-    async def guild_tree(self, message: stats.Message) -> None:
-        s = self.stats_obj
+    async def guild_tree(self, message: stats.Message, author: dict[stats.CooldownInterval, int]) -> None:
         tree = await self.get_tree(message.guild_id, message.guild_id, TreeType.guild)
-        await tree.add_water(s, message)
-        await tree.add_care(s, message)
-        self.updated_trees.add(tree)
+        tree.add_water(message)
+        tree.add_care(author, message)
+        self.mark_dirty(tree)
 
-    async def user_tree(self, message: stats.Message) -> None:
-        s = self.stats_obj
+    async def user_tree(self, message: stats.Message, author: dict[stats.CooldownInterval, int]) -> None:
         tree = await self.get_tree(message.guild_id, message.author_id, TreeType.user)
-        await tree.add_water(s, message)
-        await tree.add_care(s, message)
-        self.updated_trees.add(tree)
+        tree.add_water(message)
+        tree.add_care(author, message)
+        self.mark_dirty(tree)
 
-    async def channel_tree(self, message: stats.Message) -> None:
-        s = self.stats_obj
+    async def channel_tree(self, message: stats.Message, author: dict[stats.CooldownInterval, int]) -> None:
         tree = await self.get_tree(message.guild_id, message.channel_id, TreeType.channel)
-        await tree.add_water(s, message)
-        await tree.add_care(s, message)
-        self.updated_trees.add(tree)
+        tree.add_water(message)
+        tree.add_care(author, message)
+        self.mark_dirty(tree)
+
+    def mark_dirty(self, tree: TreeObject):
+        self.dirty[(tree.guild_id, tree.object_id)] = tree
+        self.wal.append(tree.to_record())
 
     async def get_tree(self, guild_id, object_id, type, *, connection=None) -> TreeObject:
-        for t in self.updated_trees:
-            if t.guild_id == guild_id and t.object_id == object_id:
-                return t
-        return await self._get_tree(guild_id, object_id, type, connection=connection)
+        key = (guild_id, object_id)
+        tree = self.dirty.get(key) or self.trees.get(key)
+        if tree is not None:
+            return tree
+        tree = self.flushing.get(key)
+        if tree is not None:
+            self.trees[key] = tree
+            return tree
+        # Don't let two messages load their own copy of the same tree
+        loading = self._loading.get(key)
+        if loading is not None:
+            await asyncio.wait([loading])
+            if loading.cancelled():
+                return await self.get_tree(guild_id, object_id, type, connection=connection)
+            return loading.result()
+        loading = asyncio.get_running_loop().create_future()
+        self._loading[key] = loading
+        try:
+            tree = await self._get_tree(guild_id, object_id, type, connection=connection)
+            self.trees[key] = tree
+            loading.set_result(tree)
+        finally:
+            self._loading.pop(key, None)
+            if not loading.done():
+                # Anyone waiting will try loading it again themselves
+                loading.cancel()
+        return tree
 
     async def _get_tree(self, guild_id, object_id, type, *, connection=None) -> TreeObject:
         con = connection or self.bot.pool
-        command = 'SELECT type, height, last_height, last_water, last_care, water, care FROM tree_storage WHERE guild_id = {0} AND object_id = {1};'.format(guild_id, object_id)
-        row = await con.fetchrow(command)
+        command = 'SELECT type, height, last_height, last_water, last_care, water, care FROM tree_storage WHERE guild_id = $1 AND object_id = $2;'
+        row = await con.fetchrow(command, guild_id, object_id)
         if not row:
             return TreeObject(guild_id, object_id, type, 0, time_util.get_utc(), time_util.get_utc(), time_util.get_utc(), 0, 0)
         return TreeObject(guild_id, object_id, TreeType(row['type']), row['height'], row['last_height'], row['last_water'], row['last_care'], row['water'], row['care'])
 
     async def set_status(self):
         tree = await self.get_tree(753693459369427044, 753693459369427044, TreeType.guild)
+        state = tree.state()
         activity = discord.Activity(
             type=discord.ActivityType.playing,
-            name='with chat tree | {0}% Water | {1}% Care'.format(tree.water // 10, tree.care // 10),
+            name='with chat tree | {0}% Water | {1}% Care'.format(state.water // 10, state.care // 10),
         )
         await self.bot.change_presence(status=discord.Status.online, activity=activity)
 
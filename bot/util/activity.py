@@ -0,0 +1,188 @@
+"""
+In memory sliding window counters.
+
+Each key (for stats this is ``(guild_id, channel_id, user_id)``) owns one ring buffer per window. A ring buffer
+splits its window into a fixed amount of buckets and keeps a running total, so adding and reading are both O(1)
+(advancing the ring is amortized over the buckets that expired).
+"""
+import time
+from datetime import datetime, timedelta
+from typing import Hashable, Iterator, Optional
+
+
+class WindowCounter:
+    """
+    Counts events inside a sliding window using a ring of buckets.
+    """
+
+    __slots__ = ('window', 'bucket_seconds', 'buckets', 'total', 'head', 'head_start')
+
+    def __init__(self, window: float, buckets: int = 12):
+        self.window: float = window
+        self.bucket_seconds: float = window / buckets
+        self.buckets: list[int] = [0] * buckets
+        self.total: int = 0
+        # Index of the bucket that is currently being written to
+        self.head: int = 0
+        # Start (epoch seconds) of the head bucket
+        self.head_start: float = 0
+
+    def _advance(self, now: float):
+        steps = int((now - self.head_start) // self.bucket_seconds)
+        if steps <= 0:
+            return
+        size = len(self.buckets)
+        if steps >= size:
+            # Everything has expired
+            self.buckets = [0] * size
+            self.total = 0
+            self.head = 0
+        else:
+            for _ in range(steps):
+                self.head = (self.head + 1) % size
+                self.total -= self.buckets[self.head]
+                self.buckets[self.head] = 0
+        self.head_start = now - (now - self.head_start) % self.bucket_seconds
+
+    def add(self, now: float, amount: int = 1):
+        self._advance(now)
+        self.buckets[self.head] += amount
+        self.total += amount
+
+    def count(self, now: float) -> int:
+        self._advance(now)
+        return self.total
+
+    def dump(self, now: float) -> tuple[float, list[int]]:
+        """
+        Returns the start of the head bucket and the buckets ordered from oldest to newest.
+        """
+        self._advance(now)
+        size = len(self.buckets)
+        start = self.head + 1
+        return self.head_start, [self.buckets[(start + i) % size] for i in range(size)]
+
+    def load(self, head_start: float, buckets: list[int], now: float):
+        """
+        Restores buckets that were created with :meth:`dump`.
+        """
+        size = len(self.buckets)
+        buckets = list(buckets)[-size:]
+        buckets = [0] * (size - len(buckets)) + buckets
+        self.buckets = buckets
+        self.total = sum(buckets)
+        self.head = size - 1
+        self.head_start = head_start
+        self._advance(now)
+
+    def empty(self, now: float) -> bool:
+        return self.count(now) == 0
+
+
+class ActivityCounter:
+    """
+    Groups :class:`WindowCounter` by key and by window.
+
+    Keys that receive events are marked dirty so that they can be snapshotted to the database in batches.
+    """
+
+    def __init__(self, windows: dict[Hashable, timedelta], *, buckets: int = 12):
+        self.windows = windows
+        self.bucket_amount = buckets
+        self._counters: dict[Hashable, dict[Hashable, WindowCounter]] = {}
+        self._dirty: set[Hashable] = set()
+
+    @staticmethod
+    def now() -> float:
+        return time.time()
+
+    def _create(self) -> dict[Hashable, WindowCounter]:
+        return {
+            window: WindowCounter(delta.total_seconds(), self.bucket_amount) for window, delta in self.windows.items()
+        }
+
+    def __contains__(self, key):
+        return key in self._counters
+
+    def __len__(self):
+        return len(self._counters)
+
+    def add(self, key: Hashable, amount: int = 1, *, now: Optional[float] = None):
+        if now is None:
+            now = self.now()
+        counters = self._counters.get(key)
+        if counters is None:
+            counters = self._create()
+            self._counters[key] = counters
+        for counter in counters.values():
+            counter.add(now, amount)
+        self._dirty.add(key)
+
+    def get(self, key: Hashable, window: Hashable, *, now: Optional[float] = None) -> int:
+        counters = self._counters.get(key)
+        if counters is None:
+            return 0
+        if now is None:
+            now = self.now()
+        return counters[window].count(now)
+
+    def get_all(self, key: Hashable, *, now: Optional[float] = None) -> dict[Hashable, int]:
+        counters = self._counters.get(key)
+        if counters is None:
+            return {}
+        if now is None:
+            now = self.now()
+        return {window: counter.count(now) for window, counter in counters.items()}
+
+    def load(self, key: Hashable, window: Hashable, head_start: datetime, buckets: list[int], *, now: Optional[float] = None):
+        if window not in self.windows:
+            return
+        if now is None:
+            now = self.now()
+        counters = self._counters.get(key)
+        if counters is None:
+            counters = self._create()
+            self._counters[key] = counters
+        counters[window].load(to_epoch(head_start), buckets, now)
+
+    def pop_dirty(self, *, now: Optional[float] = None) -> Iterator[tuple[Hashable, Hashable, datetime, list[int]]]:
+        """
+        Yields ``(key, window, head_start, buckets)`` for every window of every key that changed since the last call.
+        Buckets are advanced to ``now`` and ordered from oldest to newest, a window with no events left yields all
+        zeros. Keys removed by :meth:`cleanup` since they changed are skipped.
+        """
+        if now is None:
+            now = self.now()
+        dirty = self._dirty
+        self._dirty = set()
+        for key in dirty:
+            counters = self._counters.get(key)
+            if counters is None:
+                continue
+            for window, counter in counters.items():
+                head_start, buckets = counter.dump(now)
+                yield key, window, from_epoch(head_start), buckets
+
+    def cleanup(self, *, now: Optional[float] = None) -> list[Hashable]:
+        """
+        Removes keys that no longer have any events in any window. Returns the removed keys.
+        """
+        if now is None:
+            now = self.now()
+        removed = [
+            key for key, counters in self._counters.items() if all(c.empty(now) for c in counters.values())
+        ]
+        for key in removed:
+            self._counters.pop(key)
+            self._dirty.discard(key)
+        return removed
+
+
+def to_epoch(time_object: datetime) -> float:
+    """Naive UTC datetime to epoch seconds"""
+    return (time_object - datetime(1970, 1, 1)).total_seconds()
+
+
+def from_epoch(seconds: float) -> datetime:
+    """Epoch seconds to naive UTC datetime"""
+    return datetime(1970, 1, 1) + timedelta(seconds=seconds)
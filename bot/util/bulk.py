@@ -0,0 +1,260 @@
+import asyncio
+import logging
+import pathlib
+import time
+from typing import Awaitable, Callable, Optional, Sequence
+
+import asyncpg
+
+from bot.util import database as db
+from bot.util import wal as wal_util
+from bot.util.wal import WriteAheadLog
+
+# Errors caused by the records themselves (SQLSTATE classes 22 and 23, or values asyncpg can't encode). Anything else,
+# like Postgres restarting, is retried for as long as it happens.
+PERMANENT_ERRORS = (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError, ValueError, TypeError)
+
+
+class BulkWriter:
+    """
+    Buffers records in a bounded queue and writes them to a table with binary COPY.
+
+    Records are copied into a temporary staging table and then moved into the real table, so conflicts can be resolved
+    with a normal ``ON CONFLICT`` clause. When the queue is full :meth:`put` waits, which slows producers down while
+    Postgres is catching up instead of letting the buffer grow without bound.
+
+    ``derived`` maps extra columns of the table to SQL expressions over the staged columns, for values Postgres computes
+    itself (like a ``tsvector``).
+
+    If a :class:`WriteAheadLog` is given every record is logged before it's queued, and the log is released as batches
+    are committed. Records left in the log from a crash are written by :meth:`start`.
+
+    A batch that keeps failing because of its data (a constraint violation, a bad value) is written one record at a time
+    after ``max_attempts`` tries. Records that still fail are appended to ``dead_letter`` as JSON
+    lines (next to the write-ahead log by default) so the rest can move on.
+    """
+
+    def __init__(
+            self,
+            pool,
+            table: str,
+            columns: Sequence[str],
+            *,
+            conflict: str = 'ON CONFLICT DO NOTHING',
+            derived: Optional[dict[str, str]] = None,
+            flush_size: int = 500,
+            flush_interval: float = 300,
+            max_size: int = 10000,
+            retry_delay: float = 5,
+            max_attempts: int = 5,
+            wal: Optional[WriteAheadLog] = None,
+            dead_letter: Optional[pathlib.Path] = None,
+    ):
+        self.pool = pool
+        self.table = table
+        self.columns = list(columns)
+        self.conflict = conflict
+        self.derived = derived or {}
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.wal = wal
+        if dead_letter is None and wal is not None:
+            dead_letter = wal.directory / '{0}.dead'.format(table)
+        self.dead_letter = dead_letter
+        self.queue: asyncio.Queue[tuple[int, tuple]] = asyncio.Queue(maxsize=max_size)
+        self.on_flush: list[Callable[[asyncpg.Connection, str, list[tuple]], Awaitable[None]]] = []
+        self.on_commit: list[Callable[[list[tuple]], Awaitable[None]]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._pending: list[tuple[int, tuple]] = []
+        self._flush_now = asyncio.Event()
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        if self.wal is not None and not self.wal.is_open:
+            self._pending.extend((seq, tuple(record)) for seq, record in self.wal.open())
+            if self._pending:
+                logging.info('Replaying {0} records into {1} from the write-ahead log'.format(len(self._pending), self.table))
+                try:
+                    await self._write()
+                except Exception:   # noqa: E722
+                    # They stay pending and go through the retries in the background
+                    logging.exception('Failed replaying records into {0}'.format(self.table))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stops the background task and writes everything that is still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._drain(len(self._pending) + self.queue.qsize())
+        await self._write()
+        if self.wal is not None:
+            self.wal.close()
+
+    async def put(self, record: tuple):
+        seq = 0
+        if self.wal is not None:
+            seq = self.wal.append(record)
+        await self.queue.put((seq, record))
+        if self.queue.qsize() >= self.flush_size:
+            self._flush_now.set()
+
+    def add_flush_hook(self, function: Callable[[asyncpg.Connection, str, list[tuple]], Awaitable[None]]):
+        """
+        Registers a coroutine that is called inside the flush transaction with the connection, the name of the staging
+        table and the records that are being written.
+
+        Hooks run before the staged rows are moved into the real table, so they can tell new rows apart from ones that
+        already exist.
+        """
+        self.on_flush.append(function)
+
+    def remove_flush_hook(self, function):
+        if function in self.on_flush:
+            self.on_flush.remove(function)
+
+    def add_commit_hook(self, function: Callable[[list[tuple]], Awaitable[None]]):
+        """
+        Registers a coroutine that is called with the records of every batch once it's committed, so anything it
+        reads already sees them. Errors are logged since the batch can't be taken back.
+        """
+        self.on_commit.append(function)
+
+    def remove_commit_hook(self, function):
+        if function in self.on_commit:
+            self.on_commit.remove(function)
+
+    async def flush(self):
+        """Writes everything buffered right now."""
+        self._drain(self.queue.qsize())
+        await self._write()
+
+    def _drain(self, amount):
+        for _ in range(amount):
+            try:
+                self._pending.append(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+
+    async def _run(self):
+        failures = 0
+        retrying = False
+        while True:
+            # A failed batch is retried after retry_delay instead of waiting for the next flush
+            deadline = time.monotonic() + self.flush_interval
+            while not retrying:
+                # Drained right before clearing so a put that already set the event isn't missed
+                self._drain(self.flush_size - len(self._pending))
+                remaining = deadline - time.monotonic()
+                if len(self._pending) >= self.flush_size or remaining <= 0:
+                    break
+                self._flush_now.clear()
+                try:
+                    await asyncio.wait_for(self._flush_now.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    pass
+            self._drain(self.flush_size - len(self._pending))
+            try:
+                await self._write(one_by_one=failures >= self.max_attempts)
+                failures = 0
+                retrying = False
+            except Exception as e:   # noqa: E722
+                if isinstance(e, PERMANENT_ERRORS):
+                    failures += 1
+                retrying = True
+                logging.exception('Failed writing {0} records to {1}. Retrying.'.format(len(self._pending), self.table))
+                await asyncio.sleep(self.retry_delay)
+
+    async def _write(self, *, one_by_one=False):
+        async with self._lock:
+            if not self._pending:
+                return
+            batch = self._pending
+            self._pending = []
+            records = [record for _, record in batch]
+            try:
+                if one_by_one:
+                    records = await self._copy_each(records)
+                else:
+                    await self._copy(records)
+            except BaseException:
+                # Put them back in front so nothing is lost or reordered
+                self._pending = batch + self._pending
+                raise
+            if self.wal is not None:
+                self.wal.release(batch[-1][0])
+            for hook in self.on_commit:
+                try:
+                    await hook(records)
+                except Exception:   # noqa: E722
+                    logging.exception('Commit hook for {0} failed'.format(self.table))
+
+    async def _copy_each(self, records: list[tuple]) -> list[tuple]:
+        """Writes records one at a time and sets aside the ones that fail. Returns the ones that were written."""
+        written = []
+        dead = []
+        for record in records:
+            try:
+                await self._copy([record])
+            except PERMANENT_ERRORS:
+                dead.append(record)
+            else:
+                written.append(record)
+        if dead:
+            self._write_dead(dead)
+        return written
+
+    def _write_dead(self, records: list[tuple]):
+        if self.dead_letter is None:
+            logging.error('Dropped {0} records that could not be written to {1}: {2!r}'.format(len(records), self.table, records))
+            return
+        with open(self.dead_letter, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(wal_util.dumps(record))
+                f.write('\n')
+        logging.error('Moved {0} records that could not be written to {1} into {2}'.format(len(records), self.table, self.dead_letter))
+
+    async def _copy(self, records: list[tuple]):
+        async with db.MaybeAcquire(pool=self.pool) as con:
+            async with con.transaction():
+                await copy_upsert(
+                    con, self.table, self.columns, records, conflict=self.conflict, derived=self.derived, hooks=self.on_flush,
+                )
+
+
+async def copy_upsert(
+        con,
+        table: str,
+        columns: Sequence[str],
+        records: list[tuple],
+        *,
+        conflict: str = 'ON CONFLICT DO NOTHING',
+        derived: Optional[dict[str, str]] = None,
+        hooks=(),
+):
+    """
+    Binary COPYs records into a temporary staging table and moves them into ``table`` with ``conflict``. Columns in
+    ``derived`` are filled with their SQL expression while moving.
+
+    Has to be called inside of a transaction, the staging table is emptied on commit.
+    """
+    staging = '_staging_{0}'.format(table)
+    derived = derived or {}
+    column_list = ', '.join(tuple(columns) + tuple(derived))
+    select_list = ', '.join(tuple(columns) + tuple(derived.values()))
+    await con.execute(
+        'CREATE TEMPORARY TABLE IF NOT EXISTS {0} (LIKE {1} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS;'.format(staging, table),
+    )
+    await con.copy_records_to_table(staging, records=records, columns=list(columns))
+    for hook in hooks:
+        await hook(con, staging, records)
+    await con.execute(
+        'INSERT INTO {0}({1}) SELECT {2} FROM {3} {4};'.format(table, column_list, select_list, staging, conflict),
+    )
@@ -330,7 +330,7 @@ class Column:   # noqa: WPS230
         self.name = kwargs.pop('name', None)
         self.index_name = None
 
-    def create_statement(self):
+    def create_statement(self, *, inline_unique=True):
         builder = [self.name, self.column_type.to_sql()]
 
         default = self.default
@@ -342,7 +342,7 @@ class Column:   # noqa: WPS230
                 builder.append(str(default).upper())
             else:
                 builder.append('({0})'.format(default))
-        elif self.unique:
+        elif self.unique and inline_unique:
             builder.append('UNIQUE')
         if not self.nullable:
             builder.append('NOT NULL')
@@ -357,6 +357,80 @@ class PrimaryKeyColumn(Column):
         super().__init__(Integer(auto_increment=True), primary_key=True)
 
 
+DISCORD_EPOCH = 1420070400000
+
+
+def snowflake_time_sql(column):
+    """SQL expression for the UTC timestamp encoded in a Discord snowflake column"""
+    return "(to_timestamp((({0} >> 22) + {1}) / 1000.0) at time zone 'utc')".format(column, DISCORD_EPOCH)
+
+
+class RangePartition:
+    """
+    Declares that a table is range partitioned by a timestamp column.
+
+    Every partition holds one ``interval`` worth of rows. ``premake`` partitions are created ahead of time and partitions
+    that ended more than ``retention`` intervals ago can be dropped as a whole instead of deleting rows.
+
+    With ``snowflake`` the column is a Discord snowflake instead of a timestamp, and the bounds are the smallest
+    snowflakes of each interval.
+    """
+
+    intervals = {
+        'day': datetime.timedelta(days=1),
+        'week': datetime.timedelta(weeks=1),
+    }
+
+    def __init__(self, column, *, interval='day', premake=3, retention=None, snowflake=False):
+        if interval not in self.intervals:
+            raise SchemaError('partition interval must be one of {0}'.format(', '.join(self.intervals)))
+        self.column = column
+        self.interval = interval
+        self.premake = premake
+        self.retention = retention
+        self.snowflake = snowflake
+
+    @property
+    def delta(self) -> datetime.timedelta:
+        return self.intervals[self.interval]
+
+    def floor(self, time: datetime.datetime) -> datetime.datetime:
+        start = time.replace(hour=0, minute=0, second=0, microsecond=0)
+        if self.interval == 'week':
+            start = start - datetime.timedelta(days=start.weekday())
+        return start
+
+    def bound(self, time: datetime.datetime):
+        """Value of the partition column at ``time``"""
+        if not self.snowflake:
+            return time
+        millis = int((time - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+        return max(0, millis - DISCORD_EPOCH) << 22
+
+    def to_time(self, value) -> datetime.datetime:
+        """Opposite of :meth:`bound`"""
+        if not self.snowflake or value is None:
+            return value
+        return datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=(value >> 22) + DISCORD_EPOCH)
+
+    def partition_name(self, table, start: datetime.datetime) -> str:
+        return '{0}_p{1}'.format(table, start.strftime('%Y%m%d'))
+
+    def partition_start(self, table, name):
+        try:
+            return datetime.datetime.strptime(name[len(table) + 2:], '%Y%m%d')
+        except ValueError:
+            return None
+
+    def create_statement(self, table, start: datetime.datetime) -> str:
+        lower, upper = self.bound(start), self.bound(start + self.delta)
+        if not self.snowflake:
+            lower, upper = "'{0}'".format(lower.isoformat(sep=' ')), "'{0}'".format(upper.isoformat(sep=' '))
+        return 'CREATE TABLE IF NOT EXISTS {0} PARTITION OF {1} FOR VALUES FROM ({2}) TO ({3});'.format(
+            self.partition_name(table, start), table, lower, upper,
+        )
+
+
 class MaybeAcquire:
 
     def __init__(self, connection=None, cleanup=True, *, pool):
@@ -391,6 +465,7 @@ class TableMeta(type):
             table_name = name.lower()
 
         attributes['__tablename__'] = table_name
+        attributes['__partition__'] = kwargs.get('partition', None)
         tablename = table_name
 
         for attribute, attribute_value in attributes.items():
@@ -462,16 +537,30 @@ class Table(metaclass=TableMeta):
 
         builder.append(cls.tablename)
 
+        partition: RangePartition = cls.__partition__
         column_creations = []
         primary_keys = []
+        unique = []
         for col in cls.columns:
-            column_creations.append(col.create_statement())
+            # Unique constraints on a partitioned table have to contain the partition column
+            column_creations.append(col.create_statement(inline_unique=partition is None))
             if col.primary_key:
                 primary_keys.append(col.name)
+            if col.unique and partition is not None and col.default is None:
+                unique.append(col.name)
 
         if primary_keys:
+            if partition is not None and partition.column not in primary_keys:
+                primary_keys.append(partition.column)
             column_creations.append('PRIMARY KEY ({0})'.format(', '.join(primary_keys)))
+        for name in unique:
+            if name == partition.column:
+                column_creations.append('UNIQUE ({0})'.format(name))
+            else:
+                column_creations.append('UNIQUE ({0}, {1})'.format(name, partition.column))
         builder.append('({0})'.format(', '.join(column_creations)))
+        if partition is not None:
+            builder.append('PARTITION BY RANGE ({0})'.format(partition.column))
         statements.append('{0};'.format(' '.join(builder)))
 
         for column in cls.columns:
@@ -485,8 +574,98 @@ class Table(metaclass=TableMeta):
     async def create(cls, connection=None):
         sql = cls.create_table(overwrite=False)
         async with MaybeAcquire(connection=connection, pool=cls._pool) as con:
+            if cls.__partition__ is None:
+                await con.execute(sql)
+                return
+            if await cls._needs_migration(con):
+                await cls._migrate(con, sql)
+                return
             await con.execute(sql)
+            await cls.create_partitions(connection=con)
+
+    @classmethod
+    async def _needs_migration(cls, con) -> bool:
+        """If the existing table isn't partitioned, or is partitioned on something else, or has different columns"""
+        kind = await con.fetchval("SELECT relkind FROM pg_class WHERE relname = $1 AND relkind IN ('r', 'p');", cls.tablename)
+        if kind is None:
+            return False
+        if kind == 'r':
+            return True
+        key = await con.fetchval('SELECT pg_get_partkeydef($1::regclass);', cls.tablename)
+        if key != 'RANGE ({0})'.format(cls.__partition__.column):
+            return True
+        rows = await con.fetch('SELECT column_name FROM information_schema.columns WHERE table_name = $1;', cls.tablename)
+        return {r['column_name'] for r in rows} != {col.name for col in cls.columns}
+
+    @classmethod
+    async def _migrate(cls, con, sql):
+        partition: RangePartition = cls.__partition__
+        staging = '_migrate_{0}'.format(cls.tablename)
+        rows = await con.fetch('SELECT column_name FROM information_schema.columns WHERE table_name = $1;', cls.tablename)
+        existing = {r['column_name'] for r in rows}
+        # Columns that were dropped or are new are left out
+        columns = ', '.join(col.name for col in cls.columns if col.name in existing)
+        now = datetime.datetime.utcnow()
+        oldest = partition.to_time(await con.fetchval('SELECT min({0}) FROM {1};'.format(partition.column, cls.tablename)))
+        if partition.retention is not None:
+            cutoff = partition.floor(now) - partition.delta * partition.retention
+            if oldest is None or oldest < cutoff:
+                oldest = cutoff
+        oldest = partition.floor(oldest or now)
+        async with con.transaction():
+            # Copy out and drop the old table so none of its index, constraint or partition names get in the way
+            await con.execute('CREATE TEMPORARY TABLE {0} ON COMMIT DROP AS SELECT {1} FROM {2} WITH NO DATA;'.format(
+                staging, columns, cls.tablename,
+            ))
+            await con.execute('INSERT INTO {0} SELECT {1} FROM {2} WHERE {3} >= $1;'.format(
+                staging, columns, cls.tablename, partition.column,
+            ), partition.bound(oldest))
+            await con.execute('DROP TABLE {0} CASCADE;'.format(cls.tablename))
+            await con.execute(sql)
+            await cls.create_partitions(connection=con, start=oldest)
+            await con.execute('INSERT INTO {0}({1}) SELECT {1} FROM {2} ON CONFLICT DO NOTHING;'.format(
+                cls.tablename, columns, staging,
+            ))
+
+    @classmethod
+    async def create_partitions(cls, *, connection=None, start=None, now=None):
+        """Creates every partition from ``start`` (default now) up to ``premake`` intervals in the future."""
+        partition: RangePartition = cls.__partition__
+        if partition is None:
+            return
+        now = now or datetime.datetime.utcnow()
+        current = partition.floor(start or now)
+        end = partition.floor(now) + partition.delta * partition.premake
+        statements = []
+        while current <= end:
+            statements.append(partition.create_statement(cls.tablename, current))
+            current = current + partition.delta
+        async with MaybeAcquire(connection=connection, pool=cls._pool) as con:
+            await con.execute('\n'.join(statements))
+
+    @classmethod
+    async def drop_partitions(cls, *, connection=None, now=None) -> list[str]:
+        """Detaches and drops every partition that is entirely older than the retention. Returns the dropped names."""
+        partition: RangePartition = cls.__partition__
+        if partition is None or partition.retention is None:
+            return []
+        now = now or datetime.datetime.utcnow()
+        cutoff = partition.floor(now) - partition.delta * partition.retention
+        command = 'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid ' \
+                  'JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = $1;'
+        dropped = []
+        async with MaybeAcquire(connection=connection, pool=cls._pool) as con:
+            rows = await con.fetch(command, cls.tablename)
+            for row in rows:
+                name = row['relname']
+                start = partition.partition_start(cls.tablename, name)
+                if start is None or start + partition.delta > cutoff:
+                    continue
+                await con.execute('ALTER TABLE {0} DETACH PARTITION {1};'.format(cls.tablename, name))
+                await con.execute('DROP TABLE {0};'.format(name))
+                dropped.append(name)
+        return dropped
 
     @classmethod
     def all_tables(cls):
-        return cls.__subclasses__()
\ No newline at end of file
+        return cls.__subclasses__()
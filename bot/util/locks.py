@@ -0,0 +1,37 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Hashable
+
+
+class KeyedLock:
+    """
+    A lock for every key, so work on unrelated keys never waits on each other while work on the same key stays in order.
+
+    Locks only exist while something holds or waits on them, they're removed as soon as the last user leaves.
+    """
+
+    def __init__(self):
+        # Key -> [lock, how many are holding or waiting on it]
+        self._locks: dict[Hashable, list] = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    def locked(self, key) -> bool:
+        entry = self._locks.get(key)
+        return entry is not None and entry[0].locked()
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = [asyncio.Lock(), 0]
+            self._locks[key] = entry
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
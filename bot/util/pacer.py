@@ -0,0 +1,25 @@
+import asyncio
+import time
+
+
+class Pacer:
+    """
+    Spaces out requests that share a rate limit so concurrent workers don't burst into it.
+
+    Every call to :meth:`wait` reserves the next free slot, so requests go out at most ``rate`` per second no matter how
+    many workers are waiting. After a rate limit or server error :meth:`back_off` pushes every slot back.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        start = max(now, self._next)
+        self._next = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def back_off(self, seconds: float):
+        self._next = max(self._next, time.monotonic() + seconds)
@@ -1,5 +1,7 @@
-import numpy as np
 import random
+from functools import lru_cache
+
+import numpy as np
 
 
 def get_character(dx, dy, life):
@@ -21,13 +23,16 @@ class Bonsai:
     @author https://andai.tv/bonsai/
     """
 
-    def __init__(self, *, width=16, height=32, branch_prob=.05, branch_on_life=5):
+    def __init__(self, *, width=16, height=32, branch_prob=.05, branch_on_life=5, seed=None, max_cells=20000):
         # x, y, (dx, dy)
-        self.grid = np.zeros((width, height), dtype=str)
+        self.grid = np.full((width, height), ' ', dtype='<U1')
         self.width = width
         self.height = height
         self.branch_prob = branch_prob
         self.branch_on_life = branch_on_life
+        self.random = random.Random(seed)
+        # Stop drawing once this many cells have been drawn, branches can fan out a lot with a high life
+        self.max_cells = max_cells
 
     def __setitem__(self, key: tuple, value: str):
         try:
@@ -39,34 +44,52 @@ class Bonsai:
         return self.grid[item]
 
     def run(self, life=15):
-        self.branch(self.width // 2, 0, life=life, max_life=life)
+        self.branch(self.width // 2, 0, life=life)
         return self
 
-    def branch(self, x, y, *, life=15, max_life=15, branches=0):
-        branches += 1
-        while life > 0:
-            dy = -1 if random.random() < .7 else 0
-            dx = random.randint(-2,2)
-            life -= 1
+    def branch(self, x, y, *, life=15):
+        # A branch runs to completion before the branch that started it continues, so the top of the stack is always
+        # the one being drawn. Frames are [x, y, life, move] where move is a step that waits on a child branch.
+        stack = [[x, y, life, None]]
+        cells = 0
+        while stack and cells < self.max_cells:
+            current = stack[-1]
+            x, y, life, move = current
+            if move is not None:
+                dx, dy = move
+                current[3] = None
+            else:
+                if life <= 0:
+                    stack.pop()
+                    continue
+                dy = -1 if self.random.random() < .7 else 0
+                dx = self.random.randint(-2, 2)
+                life -= 1
 
-            if life % 13 == 0 or random.random() < self.branch_prob or life < self.branch_on_life:
-                self.branch(x, y, life=life, max_life=max_life, branches=branches)
+                if life % 13 == 0 or self.random.random() < self.branch_prob or life < self.branch_on_life:
+                    current[2], current[3] = life, (dx, dy)
+                    stack.append([x, y, life, None])
+                    continue
             x += dx
             y += dy
-            char = get_character(dx, dy, life)
-            self[x, y] = char
+            self[x, y] = get_character(dx, dy, life)
+            cells += 1
+            current[0], current[1], current[2] = x, y, life
 
     def __str__(self):
         return self.get_string()
 
     def get_string(self):
-        rows, columns = self.grid.shape
-        string = ''
-        for y in range(columns):
-            for x in range(rows):
-                val = self[x, y]
-                if val == '':
-                    val = ' '
-                string += val
-            string += '\n'
-        return string
+        # Each row of the transposed grid viewed as one string of width characters
+        rows = np.ascontiguousarray(self.grid.T).view('<U{0}'.format(self.width)).ravel()
+        return ''.join(row + '\n' for row in rows)
+
+    @staticmethod
+    def render(seed, life, *, width=32, height=32) -> str:
+        """Same tree for the same seed and size, rendered strings are kept around"""
+        return _render(seed, life, width, height)
+
+
+@lru_cache(maxsize=256)
+def _render(seed, life, width, height):
+    return Bonsai(width=width, height=height, seed=hash((seed, life, width, height))).run(life=life).get_string()
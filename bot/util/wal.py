@@ -0,0 +1,140 @@
+"""
+Append only write-ahead log for data that is buffered in memory before it reaches Postgres.
+
+Entries are JSON lines with an increasing sequence number. Writes go through the file buffer and are fsynced in
+batches by a background task. Once everything up to a sequence number has been committed to the database the owner
+calls :meth:`WriteAheadLog.release` and segments that only hold released entries are deleted.
+"""
+import asyncio
+import json
+import logging
+import os
+import pathlib
+from datetime import datetime
+from typing import Any, Optional
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {'$dt': value.isoformat()}
+    raise TypeError('Cannot write {0} to the write-ahead log'.format(type(value)))
+
+
+def dumps(value) -> str:
+    """One line of JSON, with datetimes kept as datetimes when read back by :meth:`WriteAheadLog.open`"""
+    return json.dumps(value, default=_encode, separators=(',', ':'))
+
+
+def _decode(value: dict):
+    if len(value) == 1 and '$dt' in value:
+        return datetime.fromisoformat(value['$dt'])
+    return value
+
+
+class WriteAheadLog:
+
+    def __init__(self, directory, name, *, sync_interval: float = 1, max_segment_size: int = 4 * 1024 * 1024):
+        self.directory = pathlib.Path(directory)
+        self.name = name
+        self.sync_interval = sync_interval
+        self.max_segment_size = max_segment_size
+        self.seq = 0
+        self._file = None
+        self._segment_start = 0
+        # First sequence number of each closed segment -> last sequence number in it
+        self._closed: dict[int, int] = {}
+        self._dirty = False
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._file is not None
+
+    def _segment_path(self, start) -> pathlib.Path:
+        return self.directory / '{0}.{1:020d}.log'.format(self.name, start)
+
+    def _segments(self) -> list[tuple[int, pathlib.Path]]:
+        segments = []
+        for path in self.directory.glob('{0}.*.log'.format(self.name)):
+            try:
+                segments.append((int(path.name[len(self.name) + 1:-4]), path))
+            except ValueError:
+                continue
+        return sorted(segments)
+
+    def open(self) -> list[tuple[int, Any]]:
+        """
+        Opens a new segment and returns every ``(seq, entry)`` that was left over from before, in order.
+
+        A partially written last line (from a crash mid write) is skipped.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for start, path in self._segments():
+            last = start - 1
+            with path.open('r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        seq, entry = json.loads(line, object_hook=_decode)
+                    except ValueError:
+                        logging.warning('Skipping torn entry in {0}'.format(path))
+                        continue
+                    entries.append((seq, entry))
+                    last = max(last, seq)
+                    self.seq = max(self.seq, seq)
+            self._closed[start] = last
+        self._new_segment()
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_event_loop().create_task(self._sync_loop())
+        return entries
+
+    def _new_segment(self):
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+            self._closed[self._segment_start] = self.seq
+        self._segment_start = self.seq + 1
+        self._file = self._segment_path(self._segment_start).open('a', encoding='utf-8')
+
+    def append(self, entry) -> int:
+        """Writes an entry and returns its sequence number. It's durable after the next sync."""
+        self.seq += 1
+        self._file.write(dumps([self.seq, entry]))
+        self._file.write('\n')
+        self._dirty = True
+        if self._file.tell() >= self.max_segment_size:
+            self._new_segment()
+        return self.seq
+
+    def release(self, seq: int):
+        """Deletes segments whose entries all have a sequence number of at most ``seq``."""
+        if self._file is not None and self.seq <= seq and self.seq >= self._segment_start:
+            self._new_segment()
+        for start, last in list(self._closed.items()):
+            if last <= seq:
+                self._segment_path(start).unlink(missing_ok=True)
+                self._closed.pop(start)
+
+    def _sync(self):
+        if not self._dirty or self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._dirty = False
+
+    async def _sync_loop(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                self._sync()
+            except OSError:
+                logging.exception('Could not sync write-ahead log {0}'.format(self.name))
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+            self._file = None
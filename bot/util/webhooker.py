@@ -225,7 +225,7 @@ class Webhooker:
         name = messages[0].content
         if not name:
             name = 'Blank'
-        async with self.bot.thread_handler.lock:
+        async with self.bot.thread_handler.locks.hold(m.id):
             thread = await m.create_thread(name=get_name(name))
             if thread.guild.id == 753693459369427044:
                 data = await ThreadData.from_thread(thread)